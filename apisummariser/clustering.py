@@ -1,11 +1,14 @@
 import numpy as np
 from hdbscan import HDBSCAN
+from scipy.sparse import csr_matrix, issparse
+from scipy.sparse.csgraph import connected_components
 from sklearn.cluster import DBSCAN
 from sklearn.cluster import KMeans
 from sklearn.cluster import MeanShift
 from kmedoids import KMedoids
 
-from apisummariser.helper.sequences_metrics import is_subseq
+from apisummariser.helper.distance_matrix import SparseDistanceMatrix
+from apisummariser.helper.sequences_metrics import encode_sequences, supersequence_lists
 
 
 class ClusteringEngine:
@@ -14,10 +17,10 @@ class ClusteringEngine:
         """
         :type callers: list
         :param callers: a list of caller methods
-        :type calls: list of lists
+        :type calls: list of lists or SequenceCorpus
         :param calls: a list of method call sequences
-        :type dist_mat: numpy array
-        :param dist_mat: the distance matrix
+        :type dist_mat: numpy array or DistanceMatrix
+        :param dist_mat: the distance matrix (a DistanceMatrix is only materialised when handed to DBSCAN/HDBSCAN)
         """
         self.callers = callers
         self.calls = calls
@@ -42,12 +45,18 @@ class ClusteringEngine:
 
     def run_dbscan(self, params):
         """
-        Performs clustering using the DBSCAN algorithm.
+        Performs clustering using the DBSCAN algorithm. For any metric other than 'precomputed', the feature vector may
+        be a sparse matrix.
 
         :type params: dictionary
-        :param params: {'eps','min_samples','metric','algorithm'}
+        :param params: {'eps','min_samples','metric','algorithm'} and the optional {'noise_center'} (see
+        form_dbscan_results)
         """
-        if params['metric'] == 'precomputed':
+        if params['metric'] == 'precomputed' and isinstance(self.dist_mat, SparseDistanceMatrix):
+            # DBSCAN modifies the sparse graph in place; pairs that are not stored are never neighbours (eps < 1.0)
+            db = DBSCAN(eps=params['eps'], min_samples=params['min_samples'], metric=params['metric'],
+                        algorithm=params['algorithm']).fit(self.dist_mat.graph.copy())
+        elif params['metric'] == 'precomputed':
             db = DBSCAN(eps=params['eps'], min_samples=params['min_samples'], metric=params['metric'],
                         algorithm=params['algorithm']).fit(self.dist_mat)
         else:
@@ -61,7 +70,7 @@ class ClusteringEngine:
         self.n_clusters_ = len(set(self.labels_l)) - (1 if -1 in self.labels_l else 0)
         print('Estimated number of clusters: %d' % self.n_clusters_)
 
-        self.form_dbscan_results()
+        self.form_dbscan_results(params.get('noise_center', True))
 
 
     def run_hdbscan(self, params):
@@ -69,21 +78,26 @@ class ClusteringEngine:
         Performs clustering using the HDBSCAN algorithm.
 
         :type params: dictionary
-        :param params: {'min_cluster_size','min_samples','metric'}
+        :param params: {'min_cluster_size','min_samples','metric'} and the optional {'noise_center'} (see
+        form_dbscan_results)
         """
-        if params['metric'] == 'precomputed':
+        if params['metric'] == 'precomputed' and isinstance(self.dist_mat, SparseDistanceMatrix):
             hdb = HDBSCAN(min_cluster_size=params['min_cluster_size'], min_samples=params['min_samples'],
-                          metric=params['metric']).fit(self.dist_mat)
+                          metric=params['metric']).fit(hdbscan_graph(self.dist_mat, params['min_samples']))
+        elif params['metric'] == 'precomputed':
+            # HDBSCAN only accepts float64 distances, while a condensed matrix may be float32
+            hdb = HDBSCAN(min_cluster_size=params['min_cluster_size'], min_samples=params['min_samples'],
+                          metric=params['metric']).fit(np.asarray(self.dist_mat, dtype=np.float64))
         else:
             hdb = HDBSCAN(min_cluster_size=params['min_cluster_size'], min_samples=params['min_samples'],
-                          metric=params['metric']).fit(self.f_vector)
+                          metric=params['metric']).fit(dense_vector(self.f_vector))
         self.labels_l = hdb.labels_
 
         # Number of clusters in labels, ignoring noise if present.
         self.n_clusters_ = len(set(self.labels_l)) - (1 if -1 in self.labels_l else 0)
         print('Estimated number of clusters: %d' % self.n_clusters_)
 
-        self.form_dbscan_results()
+        self.form_dbscan_results(params.get('noise_center', True))
 
 
     def run_kmedoids(self, params):
@@ -91,11 +105,20 @@ class ClusteringEngine:
         Performs clustering using the k-medoids algorithm.
 
         :type params: dictionary
-        :param params: {'k','t_max','init','criterion'}
+        :param params: {'k','t_max','init','criterion'} and the optional {'random_state','algorithm','n_samples',
+        'sample_size','n_init','n_jobs','assignment','metric'}, where the algorithm is one of ['alternate',
+        'fasterpam', 'clara'] (see kmedoids.k_medoids), n_init restarts run in n_jobs processes (see
+        kmedoids.k_medoids_restarts), and the assignment 'bounded' skips distance lookups if the metric of the matrix
+        is a true metric
         """
         self.n_clusters_ = params['k']
         kmedoids = KMedoids(n_clusters=params['k'], max_iter=params['t_max'], init=params['init'],
-                            criterion=params['criterion']).fit(self.dist_mat)
+                            criterion=params['criterion'], random_state=params.get('random_state', 0),
+                            algorithm=params.get('algorithm', 'alternate'), n_samples=params.get('n_samples', 5),
+                            sample_size=params.get('sample_size'), n_init=params.get('n_init', 1),
+                            n_jobs=params.get('n_jobs', 1), assignment=params.get('assignment', 'exact'),
+                            metric=params.get('metric')).fit(self.dist_mat)
+        self.inertia_ = kmedoids.inertia_
         self.centers_l = kmedoids.cluster_centers_
         self.labels_l = kmedoids.labels_
         self.form_kmedoids_results()
@@ -103,7 +126,7 @@ class ClusteringEngine:
 
     def run_kmeans(self, params):
         """
-        Runs the k-means++ algorithm for the feature vector.
+        Runs the k-means++ algorithm for the feature vector, which may be a sparse matrix.
 
         :type params: int
         :param params: {'k'}
@@ -118,9 +141,10 @@ class ClusteringEngine:
 
     def run_meanshift(self):
         """
-        Runs the Mean Shift algorithm. No parameters used in this algorithm.
+        Runs the Mean Shift algorithm. No parameters used in this algorithm. Mean Shift does not support sparse input,
+        so a sparse feature vector is converted to a dense array.
         """
-        res = MeanShift().fit(self.f_vector)
+        res = MeanShift().fit(dense_vector(self.f_vector))
         self.labels_l = res.labels_
         self.centers_l = res.cluster_centers_
         labels_unique = np.unique(self.labels_l)
@@ -133,30 +157,46 @@ class ClusteringEngine:
     def run_overlapping(self):
         """
         Runs a naive overlapping algorithm, which creates a cluster for each distinct sequence, and assigns any of
-        its (super)sequences to the cluster.
+        its (super)sequences to the cluster. The sequences are compared in their integer form, and only the distinct
+        sequences are compared with each other (see sequences_metrics.supersequence_lists), so that duplicate
+        sequences share their results.
         """
+        _, enc_calls = encode_sequences(self.calls)
+        # the distinct sequences in order of first appearance, and the ids of the data points of each one
+        distinct_ids = {}
+        distinct_seqs = []
+        members = []
+        for i, seq in enumerate(enc_calls):
+            seq = tuple(seq)
+            d = distinct_ids.get(seq)
+            if d is None:
+                d = len(distinct_seqs)
+                distinct_ids[seq] = d
+                distinct_seqs.append(seq)
+                members.append([])
+            members[d].append(i)
+        members = [np.array(ids, dtype=np.intp) for ids in members]
+
         self.cluster_seqs = {}
-        self.n_clusters_= -1
-        for i in range(len(self.calls)):
-            if self.calls[i] not in self.cluster_seqs.values():
-                l_ids = set()
-                l_callers = set()
-                for j in range(len(self.calls)):
-                    if is_subseq(self.calls[i], self.calls[j]):
-                        l_ids.add(j)
-                        l_callers.add(self.callers[j])
-                if len(l_callers) > 0:
-                    self.n_clusters_ += 1
-                    self.centers[str(self.n_clusters_)] = i
-                    self.centers_l.append(i)
-                    self.cluster_seqs[str(self.n_clusters_)] = self.calls[i]
-                    self.clusters_ids[str(self.n_clusters_)] = list(l_ids)
-                    self.clusters[str(self.n_clusters_)] = list(l_callers)
-
-
-    def form_dbscan_results(self):
+        self.n_clusters_ = -1
+        for d, supersequences in enumerate(supersequence_lists(distinct_seqs)):
+            i = int(members[d][0])
+            l_ids = np.sort(np.concatenate([members[v] for v in supersequences])).tolist()
+            self.n_clusters_ += 1
+            self.centers[str(self.n_clusters_)] = i
+            self.centers_l.append(i)
+            self.cluster_seqs[str(self.n_clusters_)] = self.calls[i]
+            self.clusters_ids[str(self.n_clusters_)] = l_ids
+            self.clusters[str(self.n_clusters_)] = list(set(self.callers[j] for j in l_ids))
+
+
+    def form_dbscan_results(self, noise_center=True):
         """
         Fills self.clusters and self.labels based on labels and callers data. Used from DBSCAN and HDBSCAN..
+
+        :type noise_center: bool
+        :param noise_center: whether the center of the noise label (-1) is computed; if False, its first data point is
+        used as its center, which avoids the support computation of what is often the largest cluster (default: True)
         """
         for i in range(len(self.labels_l)):
             self.labels[self.callers[i]] = self.labels_l[i]
@@ -171,17 +211,9 @@ class ClusteringEngine:
 
         # find clustering's centers, using the data points' intra-cluster support
         for key, value in self.clusters_ids.iteritems():
-            max_id = value[0]
-            max_support = 1
-            for v in value:
-                support = 0
-                for v1 in value:
-                    if self.dist_mat[v, v1] == 1.0:
-                        support += 1
-                if support > max_support:
-                    max_support = support
-                    max_id = v
-            self.centers[key] = max_id
+            if key == '-1' and not noise_center:
+                continue
+            self.centers[key] = support_center(self.dist_mat, value)
 
 
     def form_kmedoids_results(self):
@@ -225,3 +257,103 @@ class ClusteringEngine:
             self.run_overlapping()
         else:
             raise NotImplementedError
+
+
+def support_center(dist_mat, ids, max_block=1 << 22):
+    """
+    Finds the center of a cluster, i.e. its first data point with the largest intra-cluster support (the number of data
+    points of the cluster at distance 1.0 from it), or its first data point if no support exceeds 1. The support is
+    counted with numpy for blocks of rows of the cluster's sub-matrix, so that the sub-matrix of a large cluster is
+    never materialised at once. The support is counted on the given matrix, so with a sparse graph pruned by eps (or
+    built with 'lsh' candidates) the pruned pairs count as support, and the center may differ from the one of the full
+    matrix (see preprocessing.sparse_distance_graph).
+
+    :type dist_mat: numpy array or DistanceMatrix
+    :param dist_mat: the distance matrix
+    :type ids: list
+    :param ids: the ids of the data points of the cluster
+    :type max_block: int
+    :param max_block: the maximum number of distances of each block
+    :return: the id of the center
+    """
+    ids = np.asarray(ids, dtype=np.intp)
+    support = np.empty(len(ids), dtype=np.intp)
+    block_rows = max(1, max_block // len(ids))
+    for r0 in range(0, len(ids), block_rows):
+        rows = ids[r0:r0 + block_rows]
+        support[r0:r0 + len(rows)] = np.count_nonzero(np.asarray(dist_mat[np.ix_(rows, ids)]) == 1.0, axis=1)
+    best = np.argmax(support)
+    return int(ids[best] if support[best] > 1 else ids[0])
+
+
+def hdbscan_graph(dist_mat, min_samples):
+    """
+    Prepares a sparse distance graph for HDBSCAN, so that it is consistent with the full distance matrix:
+        - HDBSCAN ignores zero-weight edges, so zero distances are replaced by the smallest positive float
+        - the diagonal is stored, and rows with less than min_samples other distances are padded with distinct pairs
+        at the default distance, so that core distances are computed as for the full matrix
+        - HDBSCAN requires a connected graph, so connected components are chained together with pairs at the default
+        distance, which is the distance of any pair between them
+
+    :type dist_mat: SparseDistanceMatrix
+    :param dist_mat: the sparse distance graph
+    :type min_samples: int
+    :param min_samples: the min_samples parameter of HDBSCAN
+    :return graph: a scipy csr_matrix
+    """
+    n = dist_mat.shape[0]
+    graph = dist_mat.graph.tocoo()
+    off_diagonal = graph.row != graph.col
+    rows = list(graph.row[off_diagonal]) + range(n)
+    cols = list(graph.col[off_diagonal]) + range(n)
+    data = list(np.maximum(graph.data[off_diagonal], np.finfo(np.float64).tiny)) + [np.finfo(np.float64).tiny] * n
+    counts = np.bincount(graph.row[off_diagonal], minlength=n)
+    n_neighbours = min(min_samples, n - 1)
+    # the neighbours of the padded rows, including the padding pairs added so far, so that no pair is added twice
+    neighbours = {}
+
+    def row_neighbours(i):
+        if i not in neighbours:
+            neighbours[i] = set(dist_mat.graph.indices[dist_mat.graph.indptr[i]:dist_mat.graph.indptr[i + 1]].tolist())
+            neighbours[i].add(i)
+        return neighbours[i]
+
+    for i in np.flatnonzero(counts < n_neighbours).tolist():
+        j = i
+        while counts[i] < n_neighbours:
+            j = (j + 1) % n
+            if j not in row_neighbours(i):
+                rows.extend([i, j])
+                cols.extend([j, i])
+                data.extend([dist_mat.default, dist_mat.default])
+                row_neighbours(i).add(j)
+                row_neighbours(j).add(i)
+                counts[i] += 1
+                counts[j] += 1
+    graph = csr_matrix((data, (rows, cols)), shape=(n, n))
+    n_components, comp_labels = connected_components(graph, directed=False)
+    if n_components > 1:
+        _, roots = np.unique(comp_labels, return_index=True)
+        links = np.full(n_components - 1, dist_mat.default)
+        chain = csr_matrix((np.concatenate([links, links]), (np.concatenate([roots[:-1], roots[1:]]),
+                                                             np.concatenate([roots[1:], roots[:-1]]))),
+                           shape=graph.shape)
+        graph = graph + chain
+    graph.sum_duplicates()
+    assert graph.nnz == 0 or graph.data.max() <= dist_mat.default
+    assert np.all(np.diff(graph.indptr) >= n_neighbours + 1)
+    return graph
+
+
+def dense_vector(f_vector):
+    """
+    Converts a (possibly sparse) feature vector to a dense numpy array, for the estimators that do not accept sparse
+    input.
+
+    :type f_vector: numpy array or scipy sparse matrix
+    :param f_vector: the feature vector
+    :return: a numpy array
+    """
+    if issparse(f_vector):
+        return f_vector.toarray()
+    return f_vector
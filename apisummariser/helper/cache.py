@@ -0,0 +1,132 @@
+import os
+import json
+import shutil
+import hashlib
+import tempfile
+import numpy as np
+from scipy.sparse import csr_matrix
+
+import filefunctions
+from distance_matrix import CondensedDistanceMatrix, IndexedDistanceMatrix, SparseDistanceMatrix
+
+# bump this whenever the stored format or the computed distances change
+CACHE_VERSION = '1'
+# the parameters of the preprocessing step that affect the stored matrix
+CACHE_PARAMS = ['metric', 'remove_singletons', 'remove_pseudo_singletons', 'unique', 'storage', 'precision', 'sparse',
+                'eps', 'candidates', 'bands', 'rows', 'shingle', 'random_state']
+
+
+def cache_key(calls, params):
+    """
+    Computes the content address of a distance matrix, i.e. a hash of the cleaned call sequences, the metric and the
+    preprocessing parameters.
+
+    :type calls: list of lists
+    :param calls: the cleaned method call sequences
+    :type params: dictionary
+    :param params: the preprocessing parameters
+    :return: a hex digest
+    """
+    h = hashlib.sha1(CACHE_VERSION)
+    h.update(json.dumps([[p, params.get(p)] for p in CACHE_PARAMS]))
+    for seq in calls:
+        h.update('\x1f'.join(seq))
+        h.update('\x1e')
+    return h.hexdigest()
+
+
+def load_distance_matrix(cache_dir, key):
+    """
+    Opens a cached distance matrix. The stored arrays are memory-mapped read-only, so opening a matrix is instant.
+
+    :type cache_dir: str
+    :param cache_dir: the directory of the cache
+    :type key: str
+    :param key: the content address of the matrix (see cache_key)
+    :return dist_mat: the distance matrix, None if it is not cached
+    """
+    entry_dir = os.path.join(cache_dir, key)
+    meta_path = os.path.join(entry_dir, 'meta.json')
+    if not os.path.isfile(meta_path):
+        return None
+    with open(meta_path, 'r') as f:
+        meta = json.load(f)
+    # mark the entry as recently used
+    os.utime(meta_path, None)
+    if meta['storage'] == 'sparse':
+        graph = csr_matrix(tuple(np.load(os.path.join(entry_dir, name + '.npy'), mmap_mode='r')
+                                 for name in ['data', 'indices', 'indptr']), shape=(meta['n'], meta['n']))
+        return SparseDistanceMatrix(graph, meta['default'])
+    matrix = np.load(os.path.join(entry_dir, 'matrix.npy'), mmap_mode='r')
+    if meta['storage'] == 'condensed':
+        matrix = CondensedDistanceMatrix(meta['n'], meta['precision'], matrix)
+    if meta['unique']:
+        matrix = IndexedDistanceMatrix(matrix, np.load(os.path.join(entry_dir, 'index.npy'), mmap_mode='r'))
+    return matrix
+
+
+def store_distance_matrix(cache_dir, key, dist_mat, max_size):
+    """
+    Stores a distance matrix in the cache, and then evicts the least recently used matrices if the cache exceeds its
+    maximum size.
+
+    :type cache_dir: str
+    :param cache_dir: the directory of the cache
+    :type key: str
+    :param key: the content address of the matrix (see cache_key)
+    :type dist_mat: numpy array or DistanceMatrix
+    :param dist_mat: the distance matrix, as computed by Preprocessor.compute_distances
+    :type max_size: int
+    :param max_size: the maximum size of the cache in bytes
+    """
+    filefunctions.make_sure_dir_exists(cache_dir)
+    meta = {'unique': isinstance(dist_mat, IndexedDistanceMatrix)}
+    # write to a temporary directory first, so that a partially written entry is never opened
+    tmp_dir = tempfile.mkdtemp(dir=cache_dir, prefix='.tmp')
+    if meta['unique']:
+        np.save(os.path.join(tmp_dir, 'index.npy'), dist_mat.index)
+        dist_mat = dist_mat.base
+    if isinstance(dist_mat, SparseDistanceMatrix):
+        meta.update({'storage': 'sparse', 'n': dist_mat.shape[0], 'default': dist_mat.default})
+        for name in ['data', 'indices', 'indptr']:
+            np.save(os.path.join(tmp_dir, name + '.npy'), getattr(dist_mat.graph, name))
+    elif isinstance(dist_mat, CondensedDistanceMatrix):
+        meta.update({'storage': 'condensed', 'n': dist_mat.shape[0], 'precision': dist_mat.precision})
+        np.save(os.path.join(tmp_dir, 'matrix.npy'), dist_mat.data)
+    else:
+        meta.update({'storage': 'dense', 'n': dist_mat.shape[0]})
+        np.save(os.path.join(tmp_dir, 'matrix.npy'), dist_mat)
+    with open(os.path.join(tmp_dir, 'meta.json'), 'w') as f:
+        json.dump(meta, f)
+    entry_dir = os.path.join(cache_dir, key)
+    filefunctions.delete_dir(entry_dir)
+    os.rename(tmp_dir, entry_dir)
+    evict(cache_dir, max_size)
+
+
+def evict(cache_dir, max_size):
+    """
+    Removes the least recently used matrices until the size of the cache does not exceed max_size. The most recently
+    used matrix is always kept.
+
+    :type cache_dir: str
+    :param cache_dir: the directory of the cache
+    :type max_size: int
+    :param max_size: the maximum size of the cache in bytes
+    """
+    entries = []
+    total_size = 0
+    for key in os.listdir(cache_dir):
+        meta_path = os.path.join(cache_dir, key, 'meta.json')
+        if not os.path.isfile(meta_path):
+            continue
+        entry_dir = os.path.join(cache_dir, key)
+        entry_size = sum(os.path.getsize(os.path.join(entry_dir, f)) for f in os.listdir(entry_dir))
+        entries.append((os.path.getmtime(meta_path), key, entry_size))
+        total_size += entry_size
+    entries.sort()
+    for _, key, entry_size in entries[:-1]:
+        if total_size <= max_size:
+            break
+        shutil.rmtree(os.path.join(cache_dir, key))
+        total_size -= entry_size
@@ -0,0 +1,316 @@
+import os
+import json
+import shutil
+import hashlib
+import tempfile
+import numpy as np
+
+# bump this whenever the stored format changes
+CORPUS_VERSION = '2'
+
+
+class SequenceCorpus(object):
+    """
+    A list of API call sequences stored in integer form: a vocabulary table of the distinct API calls, the int32 ids of
+    the API calls of all the sequences, and the offset of each sequence in them (as in a CSR matrix). The metrics, the
+    clustering and the ranking compare the integer form (see encoded), while indexing or iterating over the corpus
+    decodes the sequences, so that it can be used wherever a list of lists of API calls is expected.
+
+    :type vocabulary: list
+    :param vocabulary: the API call of each id
+    :type tokens: numpy array
+    :param tokens: the ids of the API calls of all the sequences
+    :type offsets: numpy array
+    :param offsets: the offset of each sequence in tokens, followed by the total number of API calls
+    """
+
+    def __init__(self, vocabulary, tokens, offsets):
+        self.vocabulary = vocabulary
+        self.vocabulary_ids = dict((call, k) for k, call in enumerate(vocabulary))
+        self.tokens = tokens
+        self.offsets = offsets
+        self.enc_seqs = None
+
+
+    @classmethod
+    def from_sequences(cls, seqs):
+        """
+        Encodes a list of sequences, assigning ids to the API calls in order of first appearance.
+
+        :type seqs: list of lists
+        :param seqs: a list of method call sequences
+        :return: a SequenceCorpus
+        """
+        vocabulary_ids = {}
+        vocabulary = []
+        tokens = []
+        for seq in seqs:
+            for call in seq:
+                call_id = vocabulary_ids.get(call)
+                if call_id is None:
+                    call_id = len(vocabulary)
+                    vocabulary_ids[call] = call_id
+                    vocabulary.append(call)
+                tokens.append(call_id)
+        offsets = np.cumsum([0] + [len(seq) for seq in seqs], dtype=np.int64)
+        return cls(vocabulary, np.array(tokens, dtype=np.int32), offsets)
+
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+
+    def __iter__(self):
+        for i in xrange(len(self)):
+            yield self.decode(i)
+
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self.decode(k) for k in xrange(*i.indices(len(self)))]
+        return self.decode(i)
+
+
+    def get(self, i):
+        """
+        Returns the integer form of a sequence.
+
+        :type i: int
+        :param i: the id of the sequence
+        :return: a numpy array of the ids of its API calls
+        """
+        if i < 0:
+            i += len(self)
+        return self.tokens[self.offsets[i]:self.offsets[i + 1]]
+
+
+    def decode(self, i):
+        """
+        Returns a sequence as a list of API calls.
+
+        :type i: int
+        :param i: the id of the sequence
+        :return: a list of strings
+        """
+        return [self.vocabulary[call_id] for call_id in self.get(i).tolist()]
+
+
+    def key(self, i):
+        """
+        Returns a hashable key of a sequence, which is equal for equal sequences of the corpus.
+
+        :type i: int
+        :param i: the id of the sequence
+        :return: the bytes of its integer form
+        """
+        return self.get(i).tobytes()
+
+
+    def hash(self, i):
+        """
+        Returns the hash of a sequence (see key).
+
+        :type i: int
+        :param i: the id of the sequence
+        :return: an int
+        """
+        return hash(self.key(i))
+
+
+    def lengths(self):
+        """
+        Returns the length of each sequence.
+
+        :return: a numpy array
+        """
+        return np.diff(self.offsets)
+
+
+    def encoded(self):
+        """
+        Returns the integer form of all the sequences as lists of ints, which is what the metrics compare. The lists are
+        built once and then shared, so they must not be modified.
+
+        :return: a list of lists of ints
+        """
+        if self.enc_seqs is None:
+            tokens = self.tokens.tolist()
+            offsets = self.offsets.tolist()
+            self.enc_seqs = [tokens[offsets[i]:offsets[i + 1]] for i in xrange(len(self))]
+        return self.enc_seqs
+
+
+    def take(self, ids):
+        """
+        Returns the corpus of a subset of the sequences. Its vocabulary only keeps the API calls of these sequences, in
+        their current order.
+
+        :type ids: array like
+        :param ids: the ids of the sequences to be kept
+        :return: a SequenceCorpus
+        """
+        ids = np.asarray(ids, dtype=np.intp)
+        lengths = self.lengths()[ids]
+        offsets = np.concatenate([[0], np.cumsum(lengths)]).astype(np.int64)
+        # the position of each kept API call in self.tokens
+        positions = np.repeat(self.offsets[ids] - offsets[:-1], lengths) + np.arange(offsets[-1])
+        tokens = self.tokens[positions]
+        used, tokens = np.unique(tokens, return_inverse=True)
+        return SequenceCorpus([self.vocabulary[call_id] for call_id in used.tolist()], tokens.astype(np.int32),
+                              offsets)
+
+
+def take_sequences(calls, ids):
+    """
+    Returns a subset of the sequences of a list or a SequenceCorpus, of the same type.
+
+    :type calls: list of lists or SequenceCorpus
+    :param calls: the method call sequences
+    :type ids: list
+    :param ids: the ids of the sequences to be kept
+    :return: a list of lists or a SequenceCorpus
+    """
+    if isinstance(calls, SequenceCorpus):
+        return calls.take(ids)
+    return [calls[i] for i in ids]
+
+
+def sequence_keys(calls):
+    """
+    Returns a hashable key of each sequence of a list or a SequenceCorpus, which is equal for equal sequences.
+
+    :type calls: list of lists or SequenceCorpus
+    :param calls: the method call sequences
+    :return: a list of keys
+    """
+    if isinstance(calls, SequenceCorpus):
+        return [calls.key(i) for i in xrange(len(calls))]
+    return [tuple(seq) for seq in calls]
+
+
+def pack_strings(strings):
+    """
+    Packs a list of strings into a byte array and the offset of each string.
+
+    :type strings: list
+    :param strings: the strings
+    :return data: a numpy array of uint8
+    :return offsets: a numpy array of int64
+    """
+    return np.frombuffer(''.join(strings), dtype=np.uint8), np.cumsum([0] + [len(s) for s in strings], dtype=np.int64)
+
+
+def unpack_strings(data, offsets):
+    """
+    Unpacks the strings packed by pack_strings. The strings are interned.
+
+    :type data: numpy array
+    :param data: the byte array
+    :type offsets: numpy array
+    :param offsets: the offset of each string
+    :return: a list of strings
+    """
+    data = data.tobytes()
+    offsets = offsets.tolist()
+    return [intern(data[offsets[k]:offsets[k + 1]]) for k in xrange(len(offsets) - 1)]
+
+
+def corpus_key(arff_file_path, omit, block_size=1 << 20):
+    """
+    Computes the key of the binary corpus of a dataset, i.e. a hash of the size and the content of the .arff file and of
+    the number of omitted lines. It does not depend on the modification time, so that a regenerated but identical file
+    has the same key. Hashing the file is much faster than parsing it.
+
+    :type arff_file_path: str
+    :param arff_file_path: path of arff file
+    :type omit: int
+    :param omit: number of lines to be omitted from the dataset file
+    :type block_size: int
+    :param block_size: the size of the blocks in which the file is read, in bytes
+    :return: a hex digest
+    """
+    h = hashlib.sha1(CORPUS_VERSION)
+    h.update(json.dumps([os.path.getsize(arff_file_path), omit]))
+    with open(arff_file_path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), ''):
+            h.update(block)
+    return h.hexdigest()
+
+
+def store_corpus(corpus_dir, key, callers_file, callers_package, callers, calls):
+    """
+    Stores a dataset in a compact binary columnar format: a table of the distinct strings of the callers (a byte array
+    and the offset of each string) and the string ids of the caller files, packages and callers, along with the
+    vocabulary, the ids and the offsets of the sequences (see SequenceCorpus).
+
+    :type corpus_dir: str
+    :param corpus_dir: the directory of the corpus
+    :type key: str
+    :param key: the key of the dataset (see corpus_key)
+    :type callers_file: list
+    :param callers_file: the file of each caller
+    :type callers_package: list
+    :param callers_package: the package of each caller
+    :type callers: list
+    :param callers: a list of caller methods
+    :type calls: SequenceCorpus
+    :param calls: the method call sequences
+    """
+    string_ids = {}
+    strings = []
+
+    def encode(values):
+        ids = np.empty(len(values), dtype=np.int32)
+        for k, value in enumerate(values):
+            string_id = string_ids.get(value)
+            if string_id is None:
+                string_id = len(strings)
+                string_ids[value] = string_id
+                strings.append(value)
+            ids[k] = string_id
+        return ids
+
+    columns = {'callers_file': encode(callers_file), 'callers_package': encode(callers_package),
+               'callers': encode(callers), 'tokens': calls.tokens, 'offsets': calls.offsets}
+    columns['strings'], columns['strings_offsets'] = pack_strings(strings)
+    columns['vocabulary'], columns['vocabulary_offsets'] = pack_strings(calls.vocabulary)
+    parent_dir = os.path.dirname(os.path.abspath(corpus_dir))
+    # write to a temporary directory first, so that a partially written corpus is never opened
+    tmp_dir = tempfile.mkdtemp(dir=parent_dir, prefix='.tmp')
+    for name, column in columns.iteritems():
+        np.save(os.path.join(tmp_dir, name + '.npy'), column)
+    with open(os.path.join(tmp_dir, 'meta.json'), 'w') as f:
+        json.dump({'key': key, 'n': len(callers)}, f)
+    if os.path.exists(corpus_dir):
+        shutil.rmtree(corpus_dir)
+    os.rename(tmp_dir, corpus_dir)
+
+
+def load_corpus(corpus_dir, key):
+    """
+    Loads a dataset stored by store_corpus. The columns are memory-mapped, and only the string tables are decoded, so
+    that the sequences are never decoded.
+
+    :type corpus_dir: str
+    :param corpus_dir: the directory of the corpus
+    :type key: str
+    :param key: the key of the dataset (see corpus_key)
+    :return: (callers_file, callers_package, callers, calls) as in filefunctions.load_arff, or None if the corpus does
+    not exist or is stale
+    """
+    meta_path = os.path.join(corpus_dir, 'meta.json')
+    if not os.path.isfile(meta_path):
+        return None
+    with open(meta_path, 'r') as f:
+        meta = json.load(f)
+    if meta['key'] != key:
+        return None
+    columns = {}
+    for name in ['strings', 'strings_offsets', 'callers_file', 'callers_package', 'callers', 'vocabulary',
+                 'vocabulary_offsets', 'tokens', 'offsets']:
+        columns[name] = np.load(os.path.join(corpus_dir, name + '.npy'), mmap_mode='r')
+    table = unpack_strings(columns['strings'], columns['strings_offsets'])
+    calls = SequenceCorpus(unpack_strings(columns['vocabulary'], columns['vocabulary_offsets']), columns['tokens'],
+                           columns['offsets'])
+    return [map(table.__getitem__, columns[name].tolist()) for name in ['callers_file', 'callers_package', 'callers']] \
+        + [calls]
@@ -0,0 +1,354 @@
+import numpy as np
+from scipy.sparse import csr_matrix
+
+
+class DistanceMatrix(object):
+    """
+    Base class for distance matrices that are not stored as a dense n x n numpy array. Subclasses implement values(),
+    while this class provides numpy-like indexing (X[i, j], X[i], X[:, ids], X[np.ix_(ids, ids)]), so that code written
+    for a dense distance matrix may use any of them unchanged. Converting a distance matrix to a numpy array (e.g. when
+    it is handed to a library) materialises the full matrix.
+
+    :type n: int
+    :param n: the number of data points
+    :type dtype: numpy dtype
+    :param dtype: the type of the distances
+    """
+
+    ndim = 2
+
+    def __init__(self, n, dtype):
+        self.shape = (n, n)
+        self.dtype = np.dtype(dtype)
+
+
+    def __len__(self):
+        return self.shape[0]
+
+
+    def __array__(self, dtype=None):
+        if dtype is None:
+            return self.toarray()
+        return self.toarray().astype(dtype, copy=False)
+
+
+    def __getitem__(self, key):
+        if not isinstance(key, tuple):
+            key = (key, slice(None))
+        if len(key) != 2:
+            raise IndexError('a distance matrix is indexed by exactly two indices')
+        if isinstance(key[0], (int, long, np.integer)) and isinstance(key[1], (int, long, np.integer)):
+            return self.value(key[0] % self.shape[0], key[1] % self.shape[1])
+        rows = self.index_array(key[0])
+        cols = self.index_array(key[1])
+        # slices are combined with the other index as in numpy, i.e. X[:, ids] has shape (n, len(ids))
+        if (isinstance(key[0], slice) or isinstance(key[1], slice)) and rows.ndim == 1 and cols.ndim == 1:
+            rows = rows[:, np.newaxis]
+        rows, cols = np.broadcast_arrays(rows, cols)
+        return self.values(rows, cols)
+
+
+    def index_array(self, key):
+        """
+        Converts an index (int, slice, boolean mask or array of ids) to an array of non-negative ids.
+
+        :param key: the index
+        :return ids: a numpy array of ids
+        """
+        if isinstance(key, slice):
+            return np.arange(self.shape[0])[key]
+        ids = np.asarray(key)
+        if ids.dtype == np.bool_:
+            return np.flatnonzero(ids)
+        ids = ids.astype(np.intp)
+        return np.where(ids < 0, ids + self.shape[0], ids)
+
+
+    def values(self, rows, cols):
+        """
+        Returns the distances between pairs of data points.
+
+        :type rows: numpy array
+        :param rows: the ids of the first data point of each pair
+        :type cols: numpy array
+        :param cols: the ids of the second data point of each pair, of the same shape as rows
+        :return: a numpy array of the same shape as rows
+        """
+        raise NotImplementedError
+
+
+    def value(self, i, j):
+        """
+        Returns the distance between two data points.
+
+        :type i: int
+        :param i: the id of the first data point
+        :type j: int
+        :param j: the id of the second data point
+        :return: the distance
+        """
+        return self.values(np.array([i]), np.array([j]))[0]
+
+
+    def row(self, i):
+        """
+        Returns the distances between a data point and all data points.
+
+        :type i: int
+        :param i: the id of the data point
+        :return: a numpy array of length n
+        """
+        return self[i, :]
+
+
+    def toarray(self):
+        """
+        Materialises the full matrix as a dense numpy array.
+
+        :return: a n x n numpy array
+        """
+        dense = np.empty(self.shape, dtype=self.dtype)
+        for i in range(self.shape[0]):
+            dense[i] = self.row(i)
+        return dense
+
+
+    def take(self, ids):
+        """
+        Returns the distance matrix of a subset of the data points, e.g. after removing outliers. Subclasses may
+        override it to avoid any copies of the stored distances.
+
+        :type ids: array like
+        :param ids: the ids of the data points to be kept
+        :return: a DistanceMatrix
+        """
+        return IndexedDistanceMatrix(self, ids)
+
+
+class IndexedDistanceMatrix(DistanceMatrix):
+    """
+    A full-size view of a distance matrix computed between distinct sequences only. Data point i is mapped to the
+    distinct sequence index[i], so that the distance between data points i and j is base[index[i], index[j]].
+
+    :type base: numpy array or DistanceMatrix
+    :param base: the distance matrix of the distinct sequences
+    :type index: array like
+    :param index: the id of the distinct sequence of each data point
+    """
+
+    def __init__(self, base, index):
+        self.base = base
+        self.index = np.asarray(index, dtype=np.intp)
+        DistanceMatrix.__init__(self, len(self.index), base.dtype)
+
+
+    def values(self, rows, cols):
+        return self.base[self.index[rows], self.index[cols]]
+
+
+    def value(self, i, j):
+        return self.base[self.index[i], self.index[j]]
+
+
+    def row(self, i):
+        return self.base[self.index[i], self.index]
+
+
+    def toarray(self):
+        return np.asarray(self.base[np.ix_(self.index, self.index)], dtype=self.dtype)
+
+
+    def take(self, ids):
+        return IndexedDistanceMatrix(self.base, self.index[ids])
+
+
+class CondensedDistanceMatrix(DistanceMatrix):
+    """
+    A symmetric distance matrix that only stores its lower triangle (i.e. its upper triangle in column-major order) as a
+    flat array of n * (n - 1) / 2 reduced-precision distances. The distance between data points i > j is stored at
+    position i * (i - 1) / 2 + j, so that the rows of new data points are simply appended to the array, and the diagonal
+    is assumed to be zero. Distances are stored either as float32 or quantised to uint16, since every metric is bounded
+    to [0, 1]; distances of 0.0 and 1.0 are always stored exactly.
+
+    :type n: int
+    :param n: the number of data points
+    :type precision: string
+    :param precision: ['float32', 'uint16']
+    :type data: numpy array
+    :param data: an existing array (e.g. a numpy memmap) of n * (n - 1) / 2 stored distances, if any
+    """
+
+    # the type of the stored distances for each precision
+    storage_dtypes = {'float32': np.float32, 'uint16': np.uint16}
+    # the number of quantisation levels of a uint16 distance
+    levels = 65535
+
+    def __init__(self, n, precision='float32', data=None):
+        if precision not in self.storage_dtypes:
+            raise NotImplementedError
+        DistanceMatrix.__init__(self, n, np.float32 if precision == 'float32' else np.float64)
+        self.precision = precision
+        storage_dtype = self.storage_dtypes[precision]
+        if data is None:
+            data = np.zeros(condensed_size(n), dtype=storage_dtype)
+        elif len(data) != condensed_size(n) or data.dtype != storage_dtype:
+            raise ValueError('the condensed array does not match the size or the precision of the matrix')
+        self.data = data
+
+
+    def quantise(self, values):
+        """
+        Converts distances to the stored precision.
+
+        :type values: array like
+        :param values: the distances
+        :return: a numpy array of stored distances
+        """
+        values = np.asarray(values, dtype=np.float64)
+        if self.precision == 'float32':
+            return values.astype(np.float32)
+        q = np.rint(np.clip(values, 0.0, 1.0) * self.levels)
+        # only 0.0 and 1.0 are mapped to the extreme levels
+        q[(q == 0) & (values > 0.0)] = 1
+        q[(q == self.levels) & (values < 1.0)] = self.levels - 1
+        return q.astype(np.uint16)
+
+
+    def dequantise(self, stored):
+        """
+        Converts stored distances to distances.
+
+        :type stored: numpy array
+        :param stored: the stored distances
+        :return: a numpy array of distances
+        """
+        if self.precision == 'float32':
+            return stored
+        return stored / float(self.levels)
+
+
+    def set_row(self, i, j0, values):
+        """
+        Stores the distances between data point i and data points j0, j0 + 1, ..., j0 + len(values) - 1. Only the
+        distances to data points j < i are stored.
+
+        :type i: int
+        :param i: the id of the data point
+        :type j0: int
+        :param j0: the id of the first data point of the row
+        :type values: array like
+        :param values: the distances
+        """
+        j1 = min(j0 + len(values), i)
+        if j1 > j0:
+            offset = i * (i - 1) // 2
+            self.data[offset + j0:offset + j1] = self.quantise(values[:j1 - j0])
+
+
+    def values(self, rows, cols):
+        hi = np.maximum(rows, cols)
+        lo = np.minimum(rows, cols)
+        off_diag = hi != lo
+        out = np.zeros(rows.shape, dtype=self.dtype)
+        out[off_diag] = self.dequantise(self.data[hi[off_diag] * (hi[off_diag] - 1) // 2 + lo[off_diag]])
+        return out
+
+
+    def value(self, i, j):
+        if i == j:
+            return self.dtype.type(0)
+        if i < j:
+            i, j = j, i
+        return self.dtype.type(self.dequantise(self.data[i * (i - 1) // 2 + j]))
+
+
+    def row(self, i):
+        out = np.zeros(self.shape[0], dtype=self.dtype)
+        offset = i * (i - 1) // 2
+        out[:i] = self.dequantise(self.data[offset:offset + i])
+        js = np.arange(i + 1, self.shape[0])
+        out[i + 1:] = self.dequantise(self.data[js * (js - 1) // 2 + i])
+        return out
+
+
+    def toarray(self):
+        dense = np.zeros(self.shape, dtype=self.dtype)
+        for i in range(1, self.shape[0]):
+            offset = i * (i - 1) // 2
+            dense[i, :i] = self.dequantise(self.data[offset:offset + i])
+            dense[:i, i] = dense[i, :i]
+        return dense
+
+
+    def take(self, ids):
+        ids = self.index_array(ids)
+        sub = CondensedDistanceMatrix(len(ids), self.precision)
+        for a in range(1, len(ids)):
+            hi = np.maximum(ids[a], ids[:a])
+            lo = np.minimum(ids[a], ids[:a])
+            stored = self.data[np.maximum(hi * (hi - 1) // 2 + lo, 0)]
+            sub.data[a * (a - 1) // 2:a * (a + 1) // 2] = np.where(hi == lo, 0, stored)
+        return sub
+
+
+class SparseDistanceMatrix(DistanceMatrix):
+    """
+    A sparse distance graph, i.e. a symmetric scipy CSR matrix that stores the distances of the pairs that have been
+    evaluated (both triangles, without the diagonal); every other pair is at the default distance. Note that explicit
+    zeros (e.g. between identical sequences) are stored distances, so the graph must never be pruned of zeros.
+
+    :type graph: scipy csr_matrix
+    :param graph: the stored distances
+    :type default: float
+    :param default: the distance of the pairs that are not stored
+    """
+
+    def __init__(self, graph, default=1.0):
+        self.graph = graph.tocsr()
+        self.graph.sort_indices()
+        self.default = default
+        DistanceMatrix.__init__(self, self.graph.shape[0], np.float64)
+        # the row-major position of each stored distance, used for lookups
+        self.keys = np.repeat(np.arange(self.shape[0], dtype=np.int64), np.diff(self.graph.indptr)) * self.shape[0] + \
+            self.graph.indices
+
+
+    def values(self, rows, cols):
+        queries = rows.astype(np.int64) * self.shape[0] + cols
+        pos = np.minimum(np.searchsorted(self.keys, queries), max(len(self.keys) - 1, 0))
+        found = self.keys[pos] == queries if len(self.keys) else np.zeros(rows.shape, dtype=bool)
+        out = np.full(rows.shape, self.default, dtype=self.dtype)
+        out[found] = self.graph.data[pos[found]]
+        out[rows == cols] = 0.0
+        return out
+
+
+    def row(self, i):
+        out = np.full(self.shape[0], self.default, dtype=self.dtype)
+        start, end = self.graph.indptr[i], self.graph.indptr[i + 1]
+        out[self.graph.indices[start:end]] = self.graph.data[start:end]
+        out[i] = 0.0
+        return out
+
+
+    def take(self, ids):
+        ids = self.index_array(ids)
+        new_ids = np.full(self.shape[0], -1, dtype=np.intp)
+        new_ids[ids] = np.arange(len(ids))
+        coo = self.graph.tocoo()
+        # fancy indexing would drop the explicit zeros, so the kept entries are selected explicitly
+        kept = (new_ids[coo.row] >= 0) & (new_ids[coo.col] >= 0)
+        graph = csr_matrix((coo.data[kept], (new_ids[coo.row[kept]], new_ids[coo.col[kept]])),
+                           shape=(len(ids), len(ids)))
+        return SparseDistanceMatrix(graph, self.default)
+
+
+def condensed_size(n):
+    """
+    Returns the number of distances stored by the condensed matrix of n data points.
+
+    :type n: int
+    :param n: the number of data points
+    :return: n * (n - 1) / 2
+    """
+    return n * (n - 1) // 2
@@ -8,44 +8,178 @@ import json
 import numpy as np
 import shutil
 from distutils.dir_util import copy_tree
+from multiprocessing import Pool, cpu_count
 
+import corpus
 
-def load_arff(arff_file_path, omit=6):
+
+# this pattern handles the case where a ',' character exists in a sequence
+# which is not handled by the liac-arff library
+ARFF_PATTERN = re.compile(r"""'(?P<callerFile>.*?)'  # callerFile
+                              ,'(?P<callerPackage>.*?)'  # callerPackage
+                              ,'(?P<caller>.*?)'  # caller
+                              ,'(?P<calls>.*?)' # calls
+                              """, re.VERBOSE)
+# the class types of the API calls (except for constructors)
+CLASS_TYPE_PATTERN = re.compile('<(?!init).+?>+')
+
+
+def load_arff(arff_file_path, omit=6, n_jobs=1, use_corpus=True, cache_dir=None):
     """
-    Loads the dataset (.arff file) and stores callers and calls in lists.
+    Loads the dataset (.arff file) and stores callers in lists and calls in an integer-encoded SequenceCorpus. The
+    parsed dataset is stored in a binary corpus (see corpus.store_corpus), which later loads of a file with the same
+    content read instead, even if the file has been regenerated (see corpus.corpus_key). The corpus of each .arff file
+    name is kept in cache_dir, or next to the .arff file if there is no cache_dir.
 
     :type arff_file_path: str
     :param arff_file_path: path of arff file
     :type omit: int
     :param omit: number of lines to be omitted from the dataset file
+    :type n_jobs: int
+    :param n_jobs: the number of processes that parse the file, -1 uses all cores (default: 1, i.e. the file is
+    streamed by iter_arff)
+    :type use_corpus: bool
+    :param use_corpus: whether the binary corpus is used (default: True)
+    :type cache_dir: str
+    :param cache_dir: the directory of a persistent cache, whose 'corpus' subdirectory holds the corpus (default: None,
+    i.e. the corpus is stored next to the .arff file)
     :return caller: a list of client methods (callers)
-    :return calls: a list of API method called by the corresponding client method
+    :return calls: a SequenceCorpus of the API methods called by the corresponding client method
     """
+    if use_corpus:
+        if cache_dir is None:
+            corpus_dir = arff_file_path + '.corpus'
+        else:
+            corpus_dir = os.path.join(cache_dir, 'corpus', os.path.basename(arff_file_path))
+        key = corpus.corpus_key(arff_file_path, omit)
+        columns = corpus.load_corpus(corpus_dir, key)
+        if columns is not None:
+            return tuple(columns)
     callerFile = []
     callerPackage = []
     caller = []
     calls = []
-    # this pattern handles the case where a ',' character exists in a sequence
-    # which is not handled by the liac-arff library
-    pattern = re.compile(r"""'(?P<callerFile>.*?)'  # callerFile
-                             ,'(?P<callerPackage>.*?)'  # callerPackage
-                             ,'(?P<caller>.*?)'  # caller
-                             ,'(?P<calls>.*?)' # calls
-                             """, re.VERBOSE)
+    if n_jobs == 1:
+        records = iter_arff(arff_file_path, omit)
+    else:
+        records = iter_arff_sharded(arff_file_path, omit, n_jobs)
+    for record in records:
+        callerFile.append(record[0])
+        callerPackage.append(record[1])
+        caller.append(record[2])
+        calls.append(record[3])
+    calls = corpus.SequenceCorpus.from_sequences(calls)
+    if use_corpus:
+        try:
+            make_sure_dir_exists(os.path.dirname(os.path.abspath(corpus_dir)))
+            corpus.store_corpus(corpus_dir, key, callerFile, callerPackage, caller, calls)
+        except (IOError, OSError) as e:
+            print 'The corpus could not be stored: ' + str(e)
+    return callerFile, callerPackage, caller, calls
+
 
+def iter_arff(arff_file_path, omit=6):
+    """
+    Streams the records of the dataset (.arff file). Strings are interned, so that the packages, classes and API calls
+    that repeat across records are stored once.
+
+    :type arff_file_path: str
+    :param arff_file_path: path of arff file
+    :type omit: int
+    :param omit: number of lines to be omitted from the dataset file
+    :return: a generator of (caller file, caller package, caller, calls) tuples
+    """
     with open(arff_file_path, 'r') as f:
         for _ in xrange(omit):
             next(f)
         for line in f:
-            match = pattern.match(line)
-            callerFile.append(match.group("callerFile"))
-            callerPackage.append(match.group("callerPackage"))
-            caller.append(match.group("caller"))
-            # remove class type, if it exists (take care of constructors!)
-            calls_group = match.group("calls")
-            calls_group = re.sub('<(?!init).+?>+', '', calls_group)
-            calls.append(calls_group.split())
-    return callerFile, callerPackage, caller, calls
+            yield parse_arff_line(line)
+
+
+def parse_arff_line(line):
+    """
+    Parses a record of the dataset. Records are split on their "','" separators, which gives the same fields as
+    ARFF_PATTERN whenever each separator is followed by the next field; the pattern is only used for any other line.
+
+    :type line: str
+    :param line: a line of the dataset
+    :return: a (caller file, caller package, caller, calls) tuple
+    """
+    fields = line.split("','", 3)
+    if len(fields) == 4 and fields[0][:1] == "'" and "'" in fields[3]:
+        caller_file = fields[0][1:]
+        caller_package = fields[1]
+        caller = fields[2]
+        calls_group = fields[3][:fields[3].index("'")]
+    else:
+        match = ARFF_PATTERN.match(line)
+        if match is None:
+            raise ValueError('invalid record: ' + line)
+        caller_file = match.group("callerFile")
+        caller_package = match.group("callerPackage")
+        caller = match.group("caller")
+        calls_group = match.group("calls")
+    # remove class type, if it exists (take care of constructors!)
+    if '<' in calls_group:
+        calls_group = CLASS_TYPE_PATTERN.sub('', calls_group)
+    return intern(caller_file), intern(caller_package), intern(caller), map(intern, calls_group.split())
+
+
+def iter_arff_sharded(arff_file_path, omit=6, n_jobs=-1):
+    """
+    Parses the records of the dataset (.arff file) with a pool of processes. The file is split into shards on line
+    boundaries by byte offsets, and each process reads and parses its shards; the records are yielded in file order.
+
+    :type arff_file_path: str
+    :param arff_file_path: path of arff file
+    :type omit: int
+    :param omit: number of lines to be omitted from the dataset file
+    :type n_jobs: int
+    :param n_jobs: the number of processes, -1 uses all cores
+    :return: a generator of (caller file, caller package, caller, calls) tuples
+    """
+    if n_jobs < 1:
+        n_jobs = cpu_count()
+    # a few shards per process balance the load without holding large parts of the file in memory
+    n_shards = 4 * n_jobs
+    with open(arff_file_path, 'r') as f:
+        for _ in xrange(omit):
+            f.readline()
+        start = f.tell()
+        size = os.fstat(f.fileno()).st_size
+        bounds = [start]
+        for k in range(1, n_shards):
+            f.seek(max(start + (size - start) * k // n_shards, bounds[-1]))
+            # move to the beginning of the next line
+            f.readline()
+            bounds.append(max(f.tell(), bounds[-1]))
+        bounds.append(size)
+    shards = [(arff_file_path, bounds[k], bounds[k + 1]) for k in range(n_shards) if bounds[k] < bounds[k + 1]]
+    pool = Pool(processes=n_jobs)
+    try:
+        for records in pool.imap(parse_arff_shard, shards):
+            for record in records:
+                yield record
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def parse_arff_shard(shard):
+    """
+    Parses the records of a shard of the dataset, i.e. the lines between two byte offsets.
+
+    :type shard: tuple
+    :param shard: (path of arff file, first byte, last byte + 1)
+    :return: a list of (caller file, caller package, caller, calls) tuples
+    """
+    arff_file_path, start, end = shard
+    with open(arff_file_path, 'r') as f:
+        f.seek(start)
+        lines = f.read(end - start).split('\n')
+    if lines and not lines[-1]:
+        lines.pop()
+    return [parse_arff_line(line) for line in lines]
 
 
 def write_to_file(filepath, content):
@@ -15,6 +15,8 @@ def set_up(dataset):
     paths.parser_path = os.path.join(os.getcwd(), 'libs', 'srcml', 'srcml')
     paths.apted_path = os.path.join(os.getcwd(), 'libs', 'APTED.jar')
     paths.beautifier_path = os.path.join(os.getcwd(), 'libs', 'astyle', 'astyle')
+    # distance matrices are cached across sessions, so they are not stored in the results directory
+    paths.cache_dir = os.path.join(os.getcwd(), 'cache')
 
     paths.client_dir_path = os.path.join(os.getcwd(), 'data', 'dataset', 'source', 'client_files', dataset)
     paths.example_dir_path = os.path.join(os.getcwd(), 'data', 'dataset', 'source', 'example_files', dataset)
@@ -42,3 +44,4 @@ class Paths:
         self.arff_file_path = None
         self.example_dir_path = None
         self.namespace_dir_path = None
+        self.cache_dir = None
@@ -0,0 +1,104 @@
+import numpy as np
+
+# the Mersenne prime 2^31 - 1, the modulus of the universal hash functions
+PRIME = 2147483647
+
+
+def shingle_sets(enc_calls, shingle=1):
+    """
+    Converts each encoded sequence to the set of ids of its shingles, i.e. of its contiguous n-grams of API calls. A
+    sequence that is shorter than the shingle size is a single shingle.
+
+    :type enc_calls: list of lists
+    :param enc_calls: the sequences, encoded as lists of ints (see sequences_metrics.encode_sequences)
+    :type shingle: int
+    :param shingle: the size of the shingles, where 1 uses the set of API calls of each sequence
+    :return sets: a list of sorted numpy arrays of shingle ids
+    """
+    if shingle == 1:
+        return [np.unique(np.asarray(seq, dtype=np.int64)) for seq in enc_calls]
+    vocabulary = {}
+    sets = []
+    for seq in enc_calls:
+        seq = tuple(seq)
+        ngrams = set(seq[k:k + shingle] for k in range(max(len(seq) - shingle + 1, 1)))
+        sets.append(np.unique(np.array([vocabulary.setdefault(ngram, len(vocabulary)) for ngram in ngrams],
+                                       dtype=np.int64)))
+    return sets
+
+
+def minhash_signatures(sets, n_hashes, random_state=0, chunk_size=65536):
+    """
+    Computes the MinHash signature of each set, using n_hashes universal hash functions (a * x + b) mod PRIME. The
+    probability that two signatures agree on a hash function is the Jaccard similarity of the sets. The hash values of
+    all the shingles are computed in chunks with numpy and reduced per set. An empty set (e.g. of an empty sequence) has
+    no shingles, so its signature is PRIME, which is not a hash value, in every position.
+
+    :type sets: list of numpy arrays
+    :param sets: the sets of shingle ids (see shingle_sets)
+    :type n_hashes: int
+    :param n_hashes: the number of hash functions, i.e. the length of each signature
+    :type random_state: int
+    :param random_state: the seed of the hash functions
+    :type chunk_size: int
+    :param chunk_size: the number of shingles that are hashed at once
+    :return signatures: a (sets x n_hashes) numpy array of int64
+    """
+    rng = np.random.RandomState(random_state)
+    a = rng.randint(1, PRIME, size=n_hashes).astype(np.int64)
+    b = rng.randint(0, PRIME, size=n_hashes).astype(np.int64)
+    signatures = np.full((len(sets), n_hashes), PRIME, dtype=np.int64)
+    # reduceat cannot reduce an empty segment, so only the non-empty sets are hashed
+    ids = [i for i in range(len(sets)) if len(sets[i]) > 0]
+    start = 0
+    while start < len(ids):
+        # a chunk holds whole sets, so that each set is reduced at once
+        end = start + 1
+        n_shingles = len(sets[ids[start]])
+        while end < len(ids) and n_shingles + len(sets[ids[end]]) <= chunk_size:
+            n_shingles += len(sets[ids[end]])
+            end += 1
+        chunk = [sets[i] for i in ids[start:end]]
+        shingles = np.concatenate(chunk) % PRIME
+        offsets = np.cumsum([0] + [len(s) for s in chunk[:-1]])
+        # a, x < 2^31, so that a * x fits in an int64
+        hashes = (shingles[:, np.newaxis] * a + b) % PRIME
+        signatures[ids[start:end]] = np.minimum.reduceat(hashes, offsets, axis=0)
+        start = end
+    return signatures
+
+
+def candidate_pairs(signatures, bands, rows):
+    """
+    Finds the candidate pairs of Locality-Sensitive Hashing: the signatures are split into bands of rows hash values
+    each, and two sets are candidates if they agree on every value of at least one band. A pair with Jaccard similarity
+    s is found with probability 1 - (1 - s^rows)^bands, so more bands increase the recall and more rows increase the
+    precision. The signatures of empty sets (see minhash_signatures) are never candidates.
+
+    :type signatures: numpy array
+    :param signatures: the MinHash signatures, with at least bands * rows hash values each (see minhash_signatures)
+    :type bands: int
+    :param bands: the number of bands
+    :type rows: int
+    :param rows: the number of hash values of each band
+    :return pairs: a (pairs x 2) numpy array of distinct pairs (i, j) with i > j, sorted by i and then by j
+    """
+    n = len(signatures)
+    non_empty = np.flatnonzero(signatures[:, 0] != PRIME) if signatures.shape[1] > 0 else np.arange(n)
+    keys = []
+    for band in range(bands):
+        band_sig = np.ascontiguousarray(signatures[non_empty, band * rows:(band + 1) * rows])
+        _, buckets = np.unique(band_sig.view(np.dtype((np.void, band_sig.dtype.itemsize * rows))).ravel(),
+                               return_inverse=True)
+        order = np.argsort(buckets, kind='mergesort')
+        starts = np.concatenate([[0], np.cumsum(np.bincount(buckets))])
+        # only the buckets of more than one set yield pairs
+        for b in np.flatnonzero(np.diff(starts) > 1):
+            members = non_empty[order[starts[b]:starts[b + 1]]]
+            # members are sorted, so members[second] > members[first]
+            first, second = np.triu_indices(len(members), 1)
+            keys.append(members[second].astype(np.int64) * n + members[first])
+    if not keys:
+        return np.empty((0, 2), dtype=np.intp)
+    keys = np.unique(np.concatenate(keys))
+    return np.column_stack([keys // n, keys % n]).astype(np.intp)
@@ -1,5 +1,8 @@
 from __future__ import division
 from difflib import SequenceMatcher
+import numpy as np
+
+from corpus import SequenceCorpus
 
 
 def lcs_len(x, y):
@@ -27,6 +30,240 @@ def lcs_len(x, y):
     return C[m][n]
 
 
+def lcs_len_bounded(x, y, min_len):
+    """
+    Computes the length of the LCS between two lists, if it is at least min_len. The LCS is at least min_len if and only
+    if at most d = |x| + |y| - 2 * min_len insertions and deletions turn x into y, so the DP only computes the cells of
+    the diagonal band |i - j| <= d (Ukkonen, 1985) and stops as soon as every cell of a row exceeds d, after a
+    length-difference check that rejects most pairs in O(1).
+
+    :type x: list of strings
+    :param x: a sequence
+    :type y: list of strings
+    :param y: a sequence
+    :type min_len: int
+    :param min_len: the minimum length of the LCS that is of interest
+    :return: the length of the LCS, or None if it is shorter than min_len
+    """
+    m = len(x)
+    n = len(y)
+    d = m + n - 2 * min_len
+    if d < 0 or abs(m - n) > d:
+        return None
+    inf = d + 1
+    # E[j] is the number of insertions and deletions between x[:i] and y[:j]
+    E = [j if j <= d else inf for j in range(n + 1)]
+    for i in range(1, m + 1):
+        lo = max(1, i - d)
+        hi = min(n, i + d)
+        prev_diag = E[lo - 1]
+        E[lo - 1] = i if lo == 1 else inf
+        row_min = E[lo - 1]
+        for j in range(lo, hi + 1):
+            if x[i - 1] == y[j - 1]:
+                cell = prev_diag
+            else:
+                cell = min(E[j], E[j - 1]) + 1
+            prev_diag = E[j]
+            E[j] = cell if cell <= d else inf
+            if E[j] < row_min:
+                row_min = E[j]
+        if hi < n:
+            E[hi + 1] = inf
+        if row_min > d:
+            return None
+    if E[n] > d:
+        return None
+    return (m + n - E[n]) // 2
+
+
+def min_lcs_len(from_len, max_dist, l_seq1, l_seq2):
+    """
+    Computes the minimum length of the LCS for which an LCS-based distance does not exceed max_dist. Every LCS-based
+    distance decreases with the length of the LCS, which is at most the length of the shorter sequence.
+
+    :type from_len: function
+    :param from_len: the distance as a function of the length of the LCS (see LCS_METRICS)
+    :type max_dist: float
+    :param max_dist: the maximum distance
+    :type l_seq1: int
+    :param l_seq1: the length of the first sequence
+    :type l_seq2: int
+    :param l_seq2: the length of the second sequence
+    :return: the minimum length of the LCS, or None if the distance exceeds max_dist for every length
+    """
+    lo = 0
+    hi = min(l_seq1, l_seq2)
+    if from_len(hi, l_seq1, l_seq2) > max_dist:
+        return None
+    # binary search for the first length whose distance does not exceed max_dist
+    while lo < hi:
+        mid = (lo + hi) // 2
+        if from_len(mid, l_seq1, l_seq2) <= max_dist:
+            hi = mid
+        else:
+            lo = mid + 1
+    return lo
+
+
+def encode_sequences(seqs, vocabulary=None):
+    """
+    Maps the elements (API calls) of the given sequences to integer ids, so that every comparison performed by the
+    metrics becomes an integer comparison. The same vocabulary may be passed again to encode more sequences. A
+    SequenceCorpus is already encoded, so its own vocabulary and integer form are returned unless a vocabulary is given.
+
+    :type seqs: list of lists of strings or SequenceCorpus
+    :param seqs: the sequences to be encoded
+    :type vocabulary: dictionary
+    :param vocabulary: an existing mapping of elements to ids, which is extended in place
+    :return vocabulary: the mapping of elements to ids
+    :return encoded: the sequences as lists of ints
+    """
+    if vocabulary is None:
+        if isinstance(seqs, SequenceCorpus):
+            return seqs.vocabulary_ids, seqs.encoded()
+        vocabulary = {}
+    encoded = []
+    for seq in seqs:
+        enc_seq = []
+        for el in seq:
+            el_id = vocabulary.get(el)
+            if el_id is None:
+                el_id = len(vocabulary)
+                vocabulary[el] = el_id
+            enc_seq.append(el_id)
+        encoded.append(enc_seq)
+    return vocabulary, encoded
+
+
+def lcs_match_masks(x):
+    """
+    Computes the match masks used by the bit-parallel LCS algorithm, i.e. for each distinct element of x an int whose
+    i-th bit is set if x[i] is that element.
+
+    :type x: list
+    :param x: a sequence
+    :return masks: a dictionary that maps each element to its match mask
+    """
+    masks = {}
+    for i, el in enumerate(x):
+        masks[el] = masks.get(el, 0) | (1 << i)
+    return masks
+
+
+def lcs_len_bits(masks, m, y):
+    """
+    Computes the length of the LCS between a sequence x of length m, given its match masks, and a sequence y, using the
+    bit-parallel algorithm in O(|y| * m / w) word operations. The implementation uses Python ints as bit vectors and is
+    based on:
+    Hyyro, H. (2004). Bit-parallel LCS-length computation revisited. In Proc. 15th Australasian Workshop on
+    Combinatorial Algorithms.
+
+    :type masks: dictionary
+    :param masks: the match masks of x, as returned by lcs_match_masks
+    :type m: int
+    :param m: the length of x
+    :type y: list
+    :param y: a sequence
+    :return: the length of the LCS
+    """
+    full = (1 << m) - 1
+    v = full
+    for el in y:
+        mask = masks.get(el)
+        if mask is not None:
+            u = v & mask
+            v = ((v + u) | (v - u)) & full
+    return m - bin(v).count('1')
+
+
+def lcs_len_bulk(x, ys):
+    """
+    Computes the lengths of the LCS between a sequence and a list of sequences, using the bit-parallel algorithm. The
+    match masks of x are only computed once.
+
+    :type x: list
+    :param x: a sequence
+    :type ys: list of lists
+    :param ys: the sequences to be compared with x
+    :return: a list with the length of the LCS between x and each sequence of ys
+    """
+    masks = lcs_match_masks(x)
+    m = len(x)
+    return [lcs_len_bits(masks, m, y) for y in ys]
+
+
+def lcs_from_len(lcss, l_seq1, l_seq2):
+    """
+    Computes the 'lcs' distance given the length of the LCS and the lengths of the two sequences. Works with both
+    numbers and numpy arrays.
+
+    :type lcss: int
+    :param lcss: the length of the LCS
+    :type l_seq1: int
+    :param l_seq1: the length of the first sequence
+    :type l_seq2: int
+    :param l_seq2: the length of the second sequence
+    :return dist: the distance
+    """
+    return 1 - (2 * lcss / (l_seq1 + l_seq2))
+
+
+def lcs_mod_from_len(lcss, l_seq1, l_seq2):
+    """
+    Computes the 'lcs-mod' distance given the length of the LCS and the lengths of the two sequences. Works with both
+    numbers and numpy arrays.
+
+    :type lcss: int
+    :param lcss: the length of the LCS
+    :type l_seq1: int
+    :param l_seq1: the length of the first sequence
+    :type l_seq2: int
+    :param l_seq2: the length of the second sequence
+    :return dist: the distance
+    """
+    return (l_seq1 + l_seq2 - 2 * lcss) / (l_seq1 + l_seq2)
+
+
+def lcs_min_from_len(lcss, l_seq1, l_seq2):
+    """
+    Computes the 'lcs-min' distance given the length of the LCS and the lengths of the two sequences. Works with both
+    numbers and numpy arrays.
+
+    :type lcss: int
+    :param lcss: the length of the LCS
+    :type l_seq1: int
+    :param l_seq1: the length of the first sequence
+    :type l_seq2: int
+    :param l_seq2: the length of the second sequence
+    :return dist: the distance
+    """
+    return 1 - (lcss / np.minimum(l_seq1, l_seq2))
+
+
+def lcs_ext_from_len(lcss, l_seq1, l_seq2):
+    """
+    Computes the 'lcs-ext' distance given the length of the LCS and the lengths of the two sequences. Works with both
+    numbers and numpy arrays.
+
+    :type lcss: int
+    :param lcss: the length of the LCS
+    :type l_seq1: int
+    :param l_seq1: the length of the first sequence
+    :type l_seq2: int
+    :param l_seq2: the length of the second sequence
+    :return dist: the distance
+    """
+    min_l1l2 = np.minimum(l_seq1, l_seq2)
+    max_l1l2 = np.maximum(l_seq1, l_seq2)
+    return 1 - ((lcss ** 2) / (l_seq1 * l_seq2)) * ((min_l1l2 ** 2) / (max_l1l2 ** 2))
+
+
+# the LCS-based metrics, which are closed-form functions of the length of the LCS and the lengths of the sequences
+LCS_METRICS = {'lcs': lcs_from_len, 'lcs-mod': lcs_mod_from_len, 'lcs-min': lcs_min_from_len,
+               'lcs-ext': lcs_ext_from_len}
+
+
 def lcs(seq1, seq2):
     """
     Computes the distance between two sequences using the formula below:
@@ -41,7 +278,7 @@ def lcs(seq1, seq2):
     :param seq2: a sequence
     :return dist: the distance
     """
-    dist = 1 - (2 * lcs_len(seq1, seq2) / (len(seq1) + len(seq2)))
+    dist = lcs_from_len(lcs_len(seq1, seq2), len(seq1), len(seq2))
 
     return dist
 
@@ -60,7 +297,7 @@ def lcs_mod(seq1, seq2):
     :param seq2: a sequence
     :return dist: the distance
     """
-    dist = (len(seq1) + len(seq2) - 2 * lcs_len(seq1, seq2)) / (len(seq1) + len(seq2))
+    dist = lcs_mod_from_len(lcs_len(seq1, seq2), len(seq1), len(seq2))
 
     return dist
 
@@ -79,7 +316,7 @@ def lcs_min(seq1, seq2):
     :param seq2: a sequence
     :return dist: the distance
     """
-    dist = 1 - (lcs_len(seq1, seq2) / min(len(seq1), len(seq2)))
+    dist = lcs_min_from_len(lcs_len(seq1, seq2), len(seq1), len(seq2))
 
     return dist
 
@@ -98,12 +335,7 @@ def lcs_ext(seq1, seq2):
     :param seq2: a sequence
     :return dist: the distance
     """
-    l_seq1 = len(seq1)
-    l_seq2 = len(seq2)
-    lcss = lcs_len(seq1, seq2)
-    min_l1l2 = min(l_seq1, l_seq2)
-    max_l1l2 = max(l_seq1, l_seq2)
-    dist = 1 - ((lcss ** 2) / (l_seq1 * l_seq2)) * ((min_l1l2 ** 2) / (max_l1l2 ** 2))
+    dist = lcs_ext_from_len(lcs_len(seq1, seq2), len(seq1), len(seq2))
 
     return dist
 
@@ -140,6 +372,45 @@ def jaccard_min(seq1, seq2):
     return dist
 
 
+def jaccard_from_counts(inter, n_set1, n_set2):
+    """
+    Computes the 'jaccard' distance given the number of distinct elements that two sequences share and the number of
+    distinct elements of each sequence. Works with both numbers and numpy arrays.
+
+    :type inter: int
+    :param inter: the size of the intersection of the sets of the sequences
+    :type n_set1: int
+    :param n_set1: the number of distinct elements of the first sequence
+    :type n_set2: int
+    :param n_set2: the number of distinct elements of the second sequence
+    :return dist: the distance
+    """
+    return 1 - inter / (n_set1 + n_set2 - inter)
+
+
+def jaccard_min_from_counts(inter, n_set1, n_set2):
+    """
+    Computes the 'jaccard-min' distance given the number of distinct elements that two sequences share and the number
+    of distinct elements of each sequence. Works with both numbers and numpy arrays.
+
+    :type inter: int
+    :param inter: the size of the intersection of the sets of the sequences
+    :type n_set1: int
+    :param n_set1: the number of distinct elements of the first sequence
+    :type n_set2: int
+    :param n_set2: the number of distinct elements of the second sequence
+    :return dist: the distance
+    """
+    return 1 - inter / np.minimum(n_set1, n_set2)
+
+
+# the Jaccard-based metrics, which are closed-form functions of the sizes of the intersection and of the sets
+JACCARD_METRICS = {'jaccard': jaccard_from_counts, 'jaccard-min': jaccard_min_from_counts}
+# the metrics that satisfy the triangle inequality, which the bounded k-medoids assignment relies on; the Levenshtein
+# distance normalised by the longest length is not one of them, e.g. for ['a', 'b'], ['a', 'b', 'a'] and ['b', 'a']
+TRUE_METRICS = set(['jaccard'])
+
+
 def gestalt(seq1, seq2):
     """
     Computes the distance between two sequences using Python's difflib.SequenceMatcher:
@@ -203,6 +474,93 @@ def seqsim(seq1, seq2):
     return dist
 
 
+def seqsim_prepare(seqs):
+    """
+    Preprocesses sequences for seqsim_prepared. The ngrams of all lengths of each sequence are computed once and
+    interned to integer ids, so that each sequence becomes the set of the ids of its ngrams along with the total weight
+    (i.e. the sum of the lengths) of its ngrams.
+
+    :type seqs: list of lists of strings
+    :param seqs: the sequences
+    :return: a list of (set of ngram ids, total weight, list of the weight of each ngram id)
+    """
+    ngram_ids = {}
+    weights = []
+    prepared = []
+    for seq in seqs:
+        ids = set()
+        for i in range(1, len(seq) + 1):
+            for ngram in find_ngrams(seq, i):
+                ngram_id = ngram_ids.get(ngram)
+                if ngram_id is None:
+                    ngram_id = len(weights)
+                    ngram_ids[ngram] = ngram_id
+                    weights.append(i)
+                ids.add(ngram_id)
+        prepared.append((frozenset(ids), sum(weights[ngram_id] for ngram_id in ids), weights))
+    return prepared
+
+
+def seqsim_prepared(prep1, prep2):
+    """
+    Computes the 'seqsim' distance between two sequences preprocessed by seqsim_prepare. Only the intersection of the
+    ngram sets is computed, since the weight of the union is the sum of the total weights minus the weight of the
+    intersection. The distance is identical to the one of seqsim.
+
+    :type prep1: tuple
+    :param prep1: the first preprocessed sequence
+    :type prep2: tuple
+    :param prep2: the second preprocessed sequence
+    :return dist: the distance
+    """
+    weights = prep1[2]
+    sum_inter = sum(weights[ngram_id] for ngram_id in prep1[0] & prep2[0])
+    sum_union = prep1[1] + prep2[1] - sum_inter
+
+    sim = sum_inter / sum_union
+    dist = 1 - sim
+    return dist
+
+
+def gestalt_prepare(seqs):
+    """
+    Preprocesses sequences for gestalt_prepared. A difflib.SequenceMatcher is created for each sequence, which indexes
+    the sequence as its second sequence once, so that the index is reused by every comparison with the sequence.
+
+    :type seqs: list of lists of strings
+    :param seqs: the sequences
+    :return: a list of (sequence, SequenceMatcher)
+    """
+    prepared = []
+    for seq in seqs:
+        sm = SequenceMatcher(None)
+        sm.set_seq2(seq)
+        prepared.append((seq, sm))
+    return prepared
+
+
+def gestalt_prepared(prep1, prep2):
+    """
+    Computes the 'gestalt' distance between two sequences preprocessed by gestalt_prepare, using the SequenceMatcher of
+    the second sequence. The distance is identical to the one of gestalt.
+
+    :type prep1: tuple
+    :param prep1: the first preprocessed sequence
+    :type prep2: tuple
+    :param prep2: the second preprocessed sequence
+    :return dist: the distance
+    """
+    sm = prep2[1]
+    sm.set_seq1(prep1[0])
+    dist = 1 - sm.ratio()
+    return dist
+
+
+# the metrics that preprocess each sequence once, as pairs of functions (prepare the sequences, distance between two
+# prepared sequences)
+PREPARED_METRICS = {'seqsim': (seqsim_prepare, seqsim_prepared), 'gestalt': (gestalt_prepare, gestalt_prepared)}
+
+
 def levenshtein(seq1, seq2):
     """"
     This is a straightforward implementation of a well-known algorithm, and thus
@@ -239,6 +597,118 @@ def levenshtein(seq1, seq2):
     return dist
 
 
+def levenshtein_bounded(seq1, seq2, max_dist):
+    """
+    Computes the 'levenshtein' distance between two sequences, if it does not exceed max_dist. The distance does not
+    exceed max_dist if and only if the edit distance is at most k, the largest integer with k / max(n, m) <= max_dist,
+    so the DP only computes the cells of the diagonal band |i - j| <= k (Ukkonen, 1985) and stops as soon as every cell
+    of a row exceeds k, after a length-difference check that rejects most pairs in O(1). The distances that do not
+    exceed max_dist are identical to the ones of levenshtein.
+
+    :type seq1: a list of of strings
+    :param seq1: a sequence
+    :type seq2: a list of of strings
+    :param seq2: a sequence
+    :type max_dist: float
+    :param max_dist: the maximum distance
+    :return dist: the distance, or 1.0 if it exceeds max_dist
+    """
+    n, m = len(seq1), len(seq2)
+    if n > m:
+        seq1, seq2 = seq2, seq1
+        n, m = m, n
+    if m == 0:
+        # two empty sequences are identical, and the band width k / m is undefined
+        return 0.0
+    k = int(max_dist * m)
+    while k < m and (k + 1) / m <= max_dist:
+        k += 1
+    while k >= 0 and k / m > max_dist:
+        k -= 1
+    if m - n > k:
+        return 1.0
+    inf = k + 1
+    # current[j] is the edit distance between seq1[:j] and seq2[:i]
+    current = [j if j <= k else inf for j in range(n + 1)]
+    for i in range(1, m + 1):
+        lo = max(1, i - k)
+        hi = min(n, i + k)
+        prev_diag = current[lo - 1]
+        current[lo - 1] = i if lo == 1 else inf
+        row_min = current[lo - 1]
+        for j in range(lo, hi + 1):
+            cell = prev_diag if seq1[j - 1] == seq2[i - 1] else prev_diag + 1
+            cell = min(cell, current[j] + 1, current[j - 1] + 1)
+            prev_diag = current[j]
+            current[j] = cell if cell <= k else inf
+            if current[j] < row_min:
+                row_min = current[j]
+        if hi < n:
+            current[hi + 1] = inf
+        if row_min > k:
+            return 1.0
+    if current[n] > k:
+        return 1.0
+    return current[n] / max(n, m)
+
+
 def is_subseq(seq1, seq2):
     it = iter(seq2)
-    return all(any(c == ch for c in it) for ch in seq1)
+    # 'in' consumes the iterator up to the first match, so the calls of seq1 are matched in order
+    return all(ch in it for ch in seq1)
+
+
+def supersequence_lists(seqs):
+    """
+    Computes the subsequence-containment lattice of a list of distinct sequences, i.e. for each sequence the sequences
+    of which it is a subsequence (itself included). A supersequence is longer and contains each API call at least as
+    many times, so an inverted index maps each API call to the sequences that contain it and how many times, and the
+    candidates of a sequence are the longer sequences of the posting list of its rarest API call, narrowed by the
+    posting lists of its other API calls. The sequences are processed from the longest to the shortest, so that the
+    supersequences of the candidates are already known: the candidates are visited from the shortest, and once one is
+    found to be a supersequence, so are all of its own supersequences, which are then never compared with is_subseq.
+
+    :type seqs: list of tuples
+    :param seqs: the distinct sequences, encoded as tuples of ints (see encode_sequences)
+    :return: a list of sorted numpy arrays of the positions of the supersequences of each sequence in seqs
+    """
+    n = len(seqs)
+    lengths = np.array([len(seq) for seq in seqs], dtype=np.int64)
+    counts = []
+    postings = {}
+    for v, seq in enumerate(seqs):
+        seq_counts = {}
+        for call in seq:
+            seq_counts[call] = seq_counts.get(call, 0) + 1
+        counts.append(seq_counts)
+        for call, m in seq_counts.iteritems():
+            postings.setdefault(call, ([], []))
+            postings[call][0].append(v)
+            postings[call][1].append(m)
+    # the posting lists are sorted by the position of the sequences, so that they are searched with searchsorted
+    postings = dict((call, (np.array(ids, dtype=np.intp), np.array(mult, dtype=np.int64)))
+                    for call, (ids, mult) in postings.iteritems())
+
+    supersequences = [None] * n
+    # the last sequence that each sequence has been found to be a supersequence of
+    found_for = np.full(n, -1, dtype=np.intp)
+    for u in np.argsort(-lengths, kind='mergesort').tolist():
+        if lengths[u] == 0:
+            supersequences[u] = np.arange(n)
+            continue
+        calls = sorted(counts[u], key=lambda call: len(postings[call][0]))
+        ids, mult = postings[calls[0]]
+        candidates = ids[(mult >= counts[u][calls[0]]) & (lengths[ids] > lengths[u])]
+        for call in calls[1:]:
+            if len(candidates) == 0:
+                break
+            ids, mult = postings[call]
+            pos = np.minimum(np.searchsorted(ids, candidates), len(ids) - 1)
+            candidates = candidates[(ids[pos] == candidates) & (mult[pos] >= counts[u][call])]
+        found = [np.array([u], dtype=np.intp)]
+        for v in candidates[np.argsort(lengths[candidates], kind='mergesort')].tolist():
+            if found_for[v] != u and is_subseq(seqs[u], seqs[v]):
+                found_for[supersequences[v]] = u
+                found.append(supersequences[v])
+        supersequences[u] = np.unique(np.concatenate(found))
+    return supersequences
@@ -0,0 +1,100 @@
+import os
+import json
+import numpy as np
+
+import filefunctions
+from distance_matrix import CondensedDistanceMatrix, condensed_size
+
+
+def load_session(session_dir):
+    """
+    Loads the cleaned callers and calls of a previous session, along with the description of its distance matrix.
+
+    :type session_dir: str
+    :param session_dir: the directory of the session
+    :return callers: the cleaned callers of the previous session, None if there is no previous session
+    :return calls: the cleaned calls of the previous session
+    :return meta: a dictionary {'n','metric','storage','precision'}
+    """
+    meta_path = os.path.join(session_dir, 'meta.json')
+    if not os.path.isfile(meta_path):
+        return None, None, None
+    with open(meta_path, 'r') as f:
+        meta = json.load(f)
+    with open(os.path.join(session_dir, 'callers.json'), 'r') as f:
+        callers = json.load(f)
+    with open(os.path.join(session_dir, 'calls.json'), 'r') as f:
+        calls = json.load(f)
+    return callers, calls, meta
+
+
+def save_session(session_dir, callers, calls, meta, dist_mat=None):
+    """
+    Stores the cleaned callers and calls of a session, along with its distance matrix. The matrix is stored as a raw
+    file, so that it can be memory-mapped and extended in place by later sessions.
+
+    :type session_dir: str
+    :param session_dir: the directory of the session
+    :type callers: list
+    :param callers: the cleaned callers
+    :type calls: list of lists or SequenceCorpus
+    :param calls: the cleaned calls
+    :type meta: dictionary
+    :param meta: {'n','metric','storage','precision'}
+    :type dist_mat: numpy array or CondensedDistanceMatrix
+    :param dist_mat: the distance matrix, None if the matrix file is already up to date
+    """
+    filefunctions.make_sure_dir_exists(session_dir)
+    if dist_mat is not None:
+        if isinstance(dist_mat, CondensedDistanceMatrix):
+            dist_mat.data.tofile(os.path.join(session_dir, 'matrix.dat'))
+        else:
+            np.asarray(dist_mat, dtype=np.float64).tofile(os.path.join(session_dir, 'matrix.dat'))
+    with open(os.path.join(session_dir, 'callers.json'), 'w') as f:
+        json.dump(callers, f)
+    with open(os.path.join(session_dir, 'calls.json'), 'w') as f:
+        json.dump(list(calls), f)
+    # the meta file is written last, since it marks the session as complete
+    with open(os.path.join(session_dir, 'meta.json'), 'w') as f:
+        json.dump(meta, f)
+
+
+def open_matrix(session_dir, meta, n=None):
+    """
+    Memory-maps the distance matrix of a session for reading and writing, extending it to n data points if needed. The
+    rows of a condensed matrix are appended in place, so the stored distances are never moved; a dense matrix has to be
+    copied to a new file.
+
+    :type session_dir: str
+    :param session_dir: the directory of the session
+    :type meta: dictionary
+    :param meta: {'n','metric','storage','precision'}
+    :type n: int
+    :param n: the new number of data points (default: meta['n'])
+    :return dist_mat: a numpy memmap or a CondensedDistanceMatrix backed by a numpy memmap
+    """
+    if n is None:
+        n = meta['n']
+    matrix_path = os.path.join(session_dir, 'matrix.dat')
+    if meta['storage'] == 'condensed':
+        dtype = np.dtype(CondensedDistanceMatrix.storage_dtypes[meta['precision']])
+        with open(matrix_path, 'r+b') as f:
+            f.truncate(condensed_size(n) * dtype.itemsize)
+        data = None
+        if condensed_size(n) > 0:
+            data = np.memmap(matrix_path, dtype=dtype, mode='r+', shape=(condensed_size(n),))
+        return CondensedDistanceMatrix(n, meta['precision'], data)
+    elif meta['storage'] == 'dense':
+        n_old = meta['n']
+        if n != n_old:
+            new_path = matrix_path + '.new'
+            old_mat = np.memmap(matrix_path, dtype=np.float64, mode='r', shape=(n_old, n_old))
+            new_mat = np.memmap(new_path, dtype=np.float64, mode='w+', shape=(n, n))
+            for i in range(n_old):
+                new_mat[i, :n_old] = old_mat[i]
+            new_mat.flush()
+            del old_mat, new_mat
+            os.rename(new_path, matrix_path)
+        return np.memmap(matrix_path, dtype=np.float64, mode='r+', shape=(n, n))
+    else:
+        raise NotImplementedError
@@ -0,0 +1,102 @@
+import numpy as np
+
+from corpus import SequenceCorpus
+
+
+class SubsequenceIndex(object):
+    """
+    An index of a corpus of API call sequences, which answers which (and how many) sequences contain a query sequence
+    as a subsequence. It consists of:
+        - a posting list per API call, i.e. the sorted ids of the sequences that contain it, along with the position of
+        its first occurrence in each of them
+        - a next-occurrence table, i.e. for each API call of the corpus the position of the next occurrence of the same
+        API call in the same sequence
+    A query intersects the posting lists of its API calls, starting from the rarest one, and then verifies the remaining
+    candidates all at once, matching the API calls of the query in order by following the next-occurrence table. The
+    positions are offsets in the API calls of the whole corpus, so that they are comparable within each sequence.
+
+    :type calls: list of lists or SequenceCorpus
+    :param calls: the method call sequences to be indexed
+    """
+
+    def __init__(self, calls):
+        if not isinstance(calls, SequenceCorpus):
+            calls = SequenceCorpus.from_sequences(calls)
+        self.vocabulary = calls.vocabulary_ids
+        self.n = len(calls)
+        tokens = np.asarray(calls.tokens, dtype=np.int64)
+        seq_ids = np.repeat(np.arange(self.n), calls.lengths())
+        # the positions grouped by API call, and then by sequence and position, since the sort is stable
+        order = np.argsort(tokens, kind='mergesort')
+        same = (tokens[order][1:] == tokens[order][:-1]) & (seq_ids[order][1:] == seq_ids[order][:-1])
+        self.next_occurrence = np.full(len(tokens), -1, dtype=np.int64)
+        self.next_occurrence[order[:-1][same]] = order[1:][same]
+        # the first occurrence of each API call in each sequence is a posting
+        first = order[np.concatenate([[True], ~same])] if len(order) > 0 else order
+        self.posting_seqs = seq_ids[first]
+        self.posting_first = first
+        self.posting_offsets = np.searchsorted(tokens[first], np.arange(len(calls.vocabulary) + 1))
+
+
+    def postings(self, call_id):
+        """
+        Returns the posting list of an API call.
+
+        :type call_id: int
+        :param call_id: the id of the API call in the vocabulary
+        :return seqs: the sorted ids of the sequences that contain the API call
+        :return first: the position of its first occurrence in each of them
+        """
+        start, end = self.posting_offsets[call_id], self.posting_offsets[call_id + 1]
+        return self.posting_seqs[start:end], self.posting_first[start:end]
+
+
+    def containing(self, seq):
+        """
+        Finds the sequences of the corpus that contain a sequence as a subsequence. A sequence with an API call that is
+        not in the corpus is contained in none of them, and the empty sequence is contained in all of them.
+
+        :type seq: list
+        :param seq: the query sequence of API calls
+        :return: the sorted ids of the sequences that contain seq
+        """
+        call_ids = [self.vocabulary.get(call) for call in seq]
+        if len(call_ids) == 0:
+            return np.arange(self.n)
+        if None in call_ids:
+            return np.empty(0, dtype=np.intp)
+        distinct = sorted(set(call_ids), key=lambda call_id: self.posting_offsets[call_id + 1] -
+                          self.posting_offsets[call_id])
+        candidates = self.postings(distinct[0])[0]
+        for call_id in distinct[1:]:
+            if len(candidates) == 0:
+                break
+            seqs = self.postings(call_id)[0]
+            pos = np.minimum(np.searchsorted(seqs, candidates), len(seqs) - 1)
+            candidates = candidates[seqs[pos] == candidates]
+
+        # match the API calls in order: each one has to occur after the match of the previous one
+        matched = np.full(len(candidates), -1, dtype=np.int64)
+        for call_id in call_ids:
+            if len(candidates) == 0:
+                break
+            seqs, first = self.postings(call_id)
+            current = first[np.searchsorted(seqs, candidates)]
+            behind = np.flatnonzero(current <= matched)
+            while len(behind) > 0:
+                current[behind] = self.next_occurrence[current[behind]]
+                behind = behind[(current[behind] >= 0) & (current[behind] <= matched[behind])]
+            found = current >= 0
+            candidates, matched = candidates[found], current[found]
+        return candidates
+
+
+    def support(self, seq):
+        """
+        Counts the sequences of the corpus that contain a sequence as a subsequence (see containing).
+
+        :type seq: list
+        :param seq: the query sequence of API calls
+        :return: the number of sequences that contain seq
+        """
+        return len(self.containing(seq))
@@ -1,7 +1,12 @@
 from __future__ import division
 import numpy as np
 import random
-import copy
+import hashlib
+from multiprocessing import Pool, cpu_count
+
+from apisummariser.helper.distance_matrix import DistanceMatrix, CondensedDistanceMatrix, IndexedDistanceMatrix, \
+    SparseDistanceMatrix
+from apisummariser.helper.sequences_metrics import TRUE_METRICS
 
 
 class KMedoids:
@@ -9,6 +14,9 @@ class KMedoids:
     Performs clustering using the k-medoids algorithm. Results are stored in self.clusters. Implementation based on:
     Bauckhage, C. (2015). Numpy/scipy Recipes for Data Science: k-Medoids Clustering. Technical Report, University
     of Bonn.
+    The 'fasterpam' and 'clara' algorithms are based on:
+    Schubert, E. and Rousseeuw, P. J. (2021). Fast and eager k-medoids clustering: O(k) runtime improvement of the PAM,
+    CLARA, and CLARANS algorithms. Information Systems, 101.
 
     :type n_clusters: int
     :param n_clusters: the number of clusters to be created
@@ -18,32 +26,156 @@ class KMedoids:
     :param init: ['k-medoids++','random',list]
     :type criterion: dictionary
     :param criterion: {'medoids', 'members'}
+    :type random_state: int
+    :param random_state: the seed of the 'k-medoids++' and 'random' initialisations
+    :type algorithm: string
+    :param algorithm: ['alternate', 'fasterpam', 'clara'] (see k_medoids)
+    :type n_samples: int
+    :param n_samples: the number of samples of 'clara'
+    :type sample_size: int
+    :param sample_size: the size of each sample of 'clara' (default: 40 + 2 * n_clusters)
+    :type n_init: int
+    :param n_init: the number of restarts, seeded with random_state, random_state + 1, ...; the restart with the lowest
+    total deviation is kept
+    :type n_jobs: int
+    :param n_jobs: the number of worker processes that run the restarts, -1 uses all cores
+    :type assignment: string
+    :param assignment: ['exact', 'bounded'], the assignment step of 'alternate' (see k_medoids)
+    :type metric: string
+    :param metric: the metric of the distance matrix, which enables the 'bounded' assignment if it is a true metric
     """
 
-    def __init__(self, n_clusters, max_iter, init, criterion):
+    def __init__(self, n_clusters, max_iter, init, criterion, random_state=0, algorithm='alternate', n_samples=5,
+                 sample_size=None, n_init=1, n_jobs=1, assignment='exact', metric=None):
 
         self.n_clusters = n_clusters
         self.max_iter = max_iter
         self.init = init
         self.criterion = criterion
+        self.random_state = random_state
+        self.algorithm = algorithm
+        self.n_samples = n_samples
+        self.sample_size = sample_size
+        self.n_init = n_init
+        self.n_jobs = n_jobs
+        self.assignment = assignment
+        self.metric = metric
 
 
     def fit(self, X):
         """
-        Compute k-medoids clustering.
+        Compute k-medoids clustering. The total deviation of the result is stored in self.inertia_.
 
         :type X: numpy array
         :param X: the distance matrix to be used
         :return:
         """
-        self.cluster_centers_, self.labels_ = k_medoids(X, n_clusters = self.n_clusters, init = self.init,
-                                                        max_iter = self.max_iter, criterion = self.criterion)
+        params = {'n_clusters': self.n_clusters, 'init': self.init, 'max_iter': self.max_iter,
+                  'criterion': self.criterion, 'algorithm': self.algorithm, 'n_samples': self.n_samples,
+                  'sample_size': self.sample_size, 'assignment': self.assignment, 'metric': self.metric}
+        self.cluster_centers_, self.labels_, self.inertia_ = k_medoids_restarts(X, params, self.n_init, self.n_jobs,
+                                                                                self.random_state)
         return self
 
 
-def k_medoids(X, n_clusters, init, max_iter, criterion):
+def k_medoids_restarts(X, params, n_init, n_jobs=1, random_state=0):
+    """
+    Runs k_medoids n_init times, with the seeds random_state, random_state + 1, ..., and keeps the run with the lowest
+    total deviation (ties are broken by the lowest seed). With n_jobs != 1 the restarts run in a pool of worker
+    processes, which are forked with the distance matrix, so that the matrix is shared read-only rather than copied
+    (a memory-mapped matrix is shared through its file).
+
+    :type X: numpy array
+    :param X: the distance matrix to be used
+    :type params: dictionary
+    :param params: the parameters of k_medoids, except for random_state
+    :type n_init: int
+    :param n_init: the number of restarts
+    :type n_jobs: int
+    :param n_jobs: the number of worker processes, -1 uses all cores
+    :type random_state: int
+    :param random_state: the seed of the first restart
+    :return medoid_ids: the ids of the medoids of the best restart
+    :return labels: the ids of the clusters to which the data points have been assigned
+    :return loss: the total deviation of the best restart
+    """
+    seeds = range(random_state, random_state + n_init)
+    if n_jobs < 1:
+        n_jobs = cpu_count()
+    if n_jobs == 1 or n_init == 1:
+        init_restart_worker(X, params)
+        try:
+            results = map(run_restart, seeds)
+        finally:
+            restart_worker.clear()
+    else:
+        pool = Pool(processes=min(n_jobs, n_init), initializer=init_restart_worker, initargs=(X, params))
+        try:
+            results = list(pool.imap_unordered(run_restart, seeds))
+        finally:
+            pool.terminate()
+            pool.join()
+    loss, _, medoid_ids, labels = min(results, key=lambda result: result[:2])
+    return medoid_ids, labels, loss
+
+
+# the state of each worker process of k_medoids_restarts
+restart_worker = {}
+
+
+def init_restart_worker(X, params):
+    """
+    Initialises a worker process of k_medoids_restarts.
+
+    :type X: numpy array
+    :param X: the distance matrix to be used
+    :type params: dictionary
+    :param params: the parameters of k_medoids, except for random_state
+    """
+    restart_worker['X'] = X
+    restart_worker['params'] = params
+
+
+def run_restart(seed):
+    """
+    Runs a restart of k_medoids_restarts.
+
+    :type seed: int
+    :param seed: the random_state of the restart
+    :return: (total deviation, seed, medoid ids, labels)
+    """
+    X = restart_worker['X']
+    medoid_ids, labels = k_medoids(X, random_state=seed, **restart_worker['params'])
+    return total_deviation(X, medoid_ids, labels), seed, medoid_ids, labels
+
+
+def total_deviation(X, medoid_ids, labels):
     """
-    The main function of the k-medoids algorithm.
+    Computes the total deviation of a clustering, i.e. the sum of the distances of the data points from their medoids.
+
+    :type X: numpy array
+    :param X: the distance matrix to be used
+    :type medoid_ids: array like
+    :param medoid_ids: the ids of the medoids
+    :type labels: array like
+    :param labels: the ids of the clusters to which the data points have been assigned
+    :return: the total deviation
+    """
+    labels = np.asarray(labels, dtype=np.intp)
+    return float(np.sum(X[np.arange(len(labels)), np.asarray(medoid_ids, dtype=np.intp)[labels]]))
+
+
+def k_medoids(X, n_clusters, init, max_iter, criterion, random_state=0, algorithm='alternate', n_samples=5,
+              sample_size=None, assignment='exact', metric=None):
+    """
+    The main function of the k-medoids algorithm. The algorithm is one of:
+        - alternate: alternates between assigning the data points to their closest medoid and choosing the medoid of
+        each cluster
+        - fasterpam: swaps medoids with non-medoids eagerly, as long as a swap decreases the total deviation (see
+        fasterpam); it usually reaches a much lower total deviation than 'alternate'
+        - clara: runs 'fasterpam' on random samples of the data points, and keeps the medoids of the sample with the
+        lowest total deviation over all the data points (see clara), so that the full matrix is only read in the
+        columns of the medoids
 
     :type X: numpy array
     :param X: the distance matrix to be used
@@ -55,173 +187,428 @@ def k_medoids(X, n_clusters, init, max_iter, criterion):
     :param max_iter: the maximum number of iterations
     :type criterion: dictionary
     :param criterion: {'medoids', 'members'}
+    :type random_state: int
+    :param random_state: the seed of the 'k-medoids++' and 'random' initialisations
+    :type algorithm: string
+    :param algorithm: ['alternate', 'fasterpam', 'clara'], where the criterion is only used by 'alternate', and
+    max_iter bounds the number of cycles over the data points of 'fasterpam'
+    :type n_samples: int
+    :param n_samples: the number of samples of 'clara'
+    :type sample_size: int
+    :param sample_size: the size of each sample of 'clara' (default: 40 + 2 * n_clusters)
+    :type assignment: string
+    :param assignment: ['exact', 'bounded'], where 'bounded' keeps bounds on the distances of the data points from the
+    medoids across the iterations of 'alternate', so that only the points whose closest medoid may have changed are
+    compared with all the medoids (see kmedoids_update_clusters_bounded). It gives the same clusters as 'exact', and is
+    only used if metric is a true metric (see sequences_metrics.TRUE_METRICS) and the matrix is not sparse; otherwise
+    the exact assignment is used
+    :type metric: string
+    :param metric: the metric of the distance matrix
     :return: medoid_ids: the ids of the medoids
     :return labels: the ids of the clusters to which the data points have been assigned
 
     """
-
-    m, n = X.shape
-    # initialize k medoids
-    if init == 'random':
-        random.seed(0)
-        b = np.ascontiguousarray(X).view(np.dtype((np.void, X.dtype.itemsize * X.shape[1])))
-        _, idx = np.unique(b, return_index=True)
-        medoid_ids = np.sort(random.sample(idx, n_clusters))
-    elif init == 'k-medoids++':
-        medoid_ids = np.sort(init_centers(X, n_clusters))
-    elif type(init) is list:
-        medoid_ids = np.sort(init)
-    else:
+    if algorithm == 'clara':
+        return clara(X, n_clusters, init, max_iter, random_state, n_samples, sample_size)
+    medoid_ids = initial_medoids(X, n_clusters, init, random_state)
+    if algorithm == 'fasterpam':
+        return fasterpam(X, medoid_ids, max_iter)
+    elif algorithm != 'alternate':
         raise NotImplementedError
 
-    # create a copy of the array of medoid indices
-    medoid_ids_new = np.copy(medoid_ids)
-    # initialize a dictionary to represent clusters
-    clusters_ids = {}
-    clusters_ids_new = {}
-
+    if criterion not in ['medoids', 'members'] or assignment not in ['exact', 'bounded']:
+        raise NotImplementedError
+    bounds = None
+    if assignment == 'bounded' and metric in TRUE_METRICS and not isinstance(X, SparseDistanceMatrix):
+        bounds = {'tol': triangle_tolerance(X)}
+    labels = None
     for t in range(max_iter):
-        # determine clusters, i.e. arrays of data indices
-        clusters_ids_new = kmedoids_update_clusters(X, n_clusters, medoid_ids_new, clusters_ids_new)
+        # determine clusters, i.e. the id of the closest medoid of each data point
+        if bounds is None:
+            labels_new = kmedoids_update_clusters(X, medoid_ids)
+        else:
+            labels_new = kmedoids_update_clusters_bounded(X, medoid_ids, bounds)
 
         # update medoids
-        medoid_ids_new = kmedoids_update_medoids(X, n_clusters, medoid_ids_new, clusters_ids_new)
-
+        medoid_ids_new = kmedoids_update_medoids(X, medoid_ids, labels_new)
+        if bounds is not None:
+            shift_bounds(X, bounds, medoid_ids, medoid_ids_new, labels_new)
         medoid_ids_new = np.sort(medoid_ids_new)
 
         # check for convergence
-        if criterion == 'medoids':
-            if np.array_equal(medoid_ids, medoid_ids_new):
-                break
-        elif criterion == 'members':
-            if t > 0:
-                arrays_equal = (np.array_equal(clusters_ids[key], clusters_ids_new[key]) for key in
-                                clusters_ids.keys())
-                if all(arrays_equal):
-                    break
-        else:
-            raise NotImplementedError
-
-        clusters_ids = copy.deepcopy(clusters_ids_new)
-        medoid_ids = np.copy(medoid_ids_new)
+        if criterion == 'medoids' and np.array_equal(medoid_ids, medoid_ids_new):
+            labels = labels_new
+            break
+        elif criterion == 'members' and labels is not None and np.array_equal(labels, labels_new):
+            break
+        labels = labels_new
+        medoid_ids = medoid_ids_new
 
     else:
-        clusters_ids_new = kmedoids_update_clusters(X, n_clusters, medoid_ids_new, clusters_ids_new)
+        if bounds is None:
+            labels = kmedoids_update_clusters(X, medoid_ids)
+        else:
+            labels = kmedoids_update_clusters_bounded(X, medoid_ids, bounds)
 
-    labels = form_labels(X, clusters_ids_new)
     return medoid_ids, labels
 
 
+def initial_medoids(X, n_clusters, init, random_state=0):
+    """
+    Chooses the initial medoids.
+
+    :type X: numpy array
+    :param X: the distance matrix to be used
+    :type n_clusters: int
+    :param n_clusters: the number of clusters to be created
+    :type init: string
+    :param init: ['k-medoids++','random',list]
+    :type random_state: int
+    :param random_state: the seed of the 'k-medoids++' and 'random' initialisations
+    :return medoid_ids: the sorted ids of the medoids
+    """
+    if init == 'random':
+        random.seed(random_state)
+        if isinstance(X, DistanceMatrix):
+            idx = unique_row_ids(X)
+        else:
+            b = np.ascontiguousarray(X).view(np.dtype((np.void, X.dtype.itemsize * X.shape[1])))
+            _, idx = np.unique(b, return_index=True)
+        medoid_ids = np.sort(random.sample(idx, n_clusters))
+    elif init == 'k-medoids++':
+        medoid_ids = np.sort(init_centers(X, n_clusters, random_state))
+    elif type(init) is list:
+        medoid_ids = np.sort(init)
+    else:
+        raise NotImplementedError
+    return medoid_ids
+
+
+def fasterpam(X, medoid_ids, max_iter):
+    """
+    Improves the medoids with the eager swap phase of FasterPAM. The data points are visited cyclically, and for each
+    non-medoid the change of the total deviation is computed for swapping it with each of the medoids at once (in
+    O(n + k) numpy operations, from the distances to the nearest and the second nearest medoid of each data point). The
+    best swap is applied as soon as it decreases the total deviation, and the search stops once a full cycle brings no
+    swap. The distance matrix is assumed to be symmetric, as built by the preprocessing step, so that it is read by
+    rows.
 
-def form_labels(X, clusters_ids):
+    :type X: numpy array
+    :param X: the distance matrix to be used
+    :type medoid_ids: array like
+    :param medoid_ids: the ids of the initial medoids
+    :type max_iter: int
+    :param max_iter: the maximum number of cycles over the data points
+    :return medoid_ids: the sorted ids of the medoids
+    :return labels: the ids of the clusters to which the data points have been assigned
     """
-    Fills the list of labels.
+    n = X.shape[0]
+    medoid_ids = np.array(medoid_ids, dtype=np.intp)
+    k = len(medoid_ids)
+    is_medoid = np.zeros(n, dtype=bool)
+    is_medoid[medoid_ids] = True
+    nearest, dn, ds = nearest_medoids(X, medoid_ids)
+    # the increase of the total deviation caused by removing each medoid
+    removal = np.bincount(nearest, weights=ds - dn, minlength=k)
+    last_swap = 0
+    for step in range(max_iter * n):
+        c = step % n
+        if step > 0 and c == last_swap:
+            break
+        if is_medoid[c]:
+            continue
+        dc = np.asarray(X.row(c) if isinstance(X, DistanceMatrix) else X[c], dtype=np.float64)
+        # the data points closer to c than to their medoid move to c, whichever medoid is removed
+        gain = np.minimum(dc - dn, 0).sum()
+        # if its medoid is removed, a data point moves to c or to its second medoid, whichever is closer (the gain of
+        # the points closer to c is counted once, in gain)
+        delta = removal + np.bincount(nearest, weights=np.minimum(np.maximum(dc, dn), ds) - ds, minlength=k)
+        i = np.argmin(delta)
+        if delta[i] + gain < -1e-12:
+            is_medoid[medoid_ids[i]] = False
+            is_medoid[c] = True
+            medoid_ids[i] = c
+            nearest, dn, ds = nearest_medoids(X, medoid_ids)
+            removal = np.bincount(nearest, weights=ds - dn, minlength=k)
+            last_swap = c
+    medoid_ids = np.sort(medoid_ids)
+    return medoid_ids, nearest_medoids(X, medoid_ids)[0]
+
+
+def clara(X, n_clusters, init, max_iter, random_state=0, n_samples=5, sample_size=None):
+    """
+    Performs CLARA clustering: FasterPAM is run on the distance matrix of each of n_samples random samples of the data
+    points, every data point is then assigned to its closest medoid in bulk, and the medoids with the lowest total
+    deviation over all the data points are kept. Each sample after the first one includes the best medoids found so
+    far, so that the total deviation never increases.
 
     :type X: numpy array
     :param X: the distance matrix to be used
-    :type clusters_ids: dict
-    :param clusters_ids: clusters results, stored in dictionary
+    :type n_clusters: int
+    :param n_clusters: the number of clusters to be created
+    :type init: string
+    :param init: ['k-medoids++','random',list], the initialisation of each sample, where a list of medoids is included
+    in the first sample instead
+    :type max_iter: int
+    :param max_iter: the maximum number of cycles of FasterPAM over each sample
+    :type random_state: int
+    :param random_state: the seed of the samples and of their initialisation
+    :type n_samples: int
+    :param n_samples: the number of samples
+    :type sample_size: int
+    :param sample_size: the size of each sample (default: 40 + 2 * n_clusters)
+    :return medoid_ids: the sorted ids of the medoids
     :return labels: the ids of the clusters to which the data points have been assigned
     """
-    labels = np.zeros(X.shape[0], dtype=int)
-    for key, value in clusters_ids.iteritems():
-        for idx in value:
-            labels[idx] = int(key)
-    return labels
+    n = X.shape[0]
+    if sample_size is None:
+        sample_size = 40 + 2 * n_clusters
+    sample_size = min(max(sample_size, n_clusters), n)
+    rng = np.random.RandomState(random_state)
+    best_ids = np.sort(init) if type(init) is list else np.empty(0, dtype=np.intp)
+    best_loss = np.inf
+    best_labels = None
+    for s in range(n_samples):
+        others = np.setdiff1d(np.arange(n), best_ids)
+        sample = np.sort(np.concatenate([best_ids, rng.choice(others, sample_size - len(best_ids), replace=False)]))
+        sub = np.asarray(X[np.ix_(sample, sample)], dtype=np.float64)
+        if len(best_ids):
+            sub_ids = np.searchsorted(sample, best_ids)
+        else:
+            sub_ids = initial_medoids(sub, n_clusters, init, rng.randint(2 ** 31 - 1))
+        sub_ids, _ = fasterpam(sub, sub_ids, max_iter)
+        medoid_ids = sample[sub_ids]
+        labels, dn, _ = nearest_medoids(X, medoid_ids)
+        if dn.sum() < best_loss:
+            best_ids, best_loss, best_labels = medoid_ids, dn.sum(), labels
+    return best_ids, best_labels
 
 
-def dist_from_centers(X, medoids):
+def nearest_medoids(X, medoid_ids):
     """
-    Computes distances between points and medoids.
+    Finds the nearest and the second nearest medoid of each data point.
 
     :type X: numpy array
     :param X: the distance matrix to be used
-    :type medoids: list
-    :param medoids: the medoids generated so far
-    :return D:the distance matrix used in the k++ initialisation
+    :type medoid_ids: array like
+    :param medoid_ids: the ids of the medoids
+    :return nearest: the cluster id (i.e. the position in medoid_ids) of the nearest medoid of each data point
+    :return dn: the distance of each data point from its nearest medoid
+    :return ds: the distance of each data point from its second nearest medoid (with a single medoid, a distance larger
+    than any other)
     """
-    D = np.array([min([X[i, c] for c in medoids]) for i in range(X.shape[0])])
-    return D
+    D = np.asarray(X[:, medoid_ids], dtype=np.float64)
+    rows = np.arange(D.shape[0])
+    nearest = np.argmin(D, axis=1)
+    dn = D[rows, nearest]
+    if D.shape[1] == 1:
+        return nearest, dn, np.full(len(dn), 2 * D.max() + 1)
+    D[rows, nearest] = np.inf
+    return nearest, dn, D.min(axis=1)
 
 
-def choose_next_center(X):
+def unique_row_ids(X):
     """
-    Choose next medoid randomly based on the probability distribution D / D.sum().
+    Finds the data points with distinct rows in a DistanceMatrix, hashing one row at a time so that the square matrix
+    is never materialised.
 
-    :type X: numpy array
+    :type X: DistanceMatrix
     :param X: the distance matrix to be used
-    :return ind: the index of the selected medoid
+    :return idx: the ids of the first data point of each distinct row
     """
-    probs = X / X.sum()
-    cumprobs = probs.cumsum()
-    random.seed(0)
-    r = random.random()
-    ind = np.where(cumprobs >= r)[0][0]
-    return ind
+    seen = set()
+    idx = []
+    for i in range(X.shape[0]):
+        digest = hashlib.sha1(X.row(i).tobytes()).digest()
+        if digest not in seen:
+            seen.add(digest)
+            idx.append(i)
+    return idx
 
 
-def init_centers(X, n_clusters):
+def init_centers(X, n_clusters, random_state=0):
     """
-    Initialise medoids using the k++ technique.
+    Initialise medoids using the k++ technique: the first medoid is chosen uniformly at random, and each next medoid is
+    chosen with probability proportional to its distance from the closest medoid chosen so far. The distances from the
+    closest medoid are kept in a vector, which is updated with the column of each new medoid, so that each step reads
+    a single column of the distance matrix.
 
     :type X: numpy array
     :param X: the distance matrix to be used
     :type n_clusters: int
     :param n_clusters: the number of clusters
+    :type random_state: int
+    :param random_state: the seed of the random choices
     :return medoids: medoids' indices
     """
-    # choose first medoid randomly
-    # mu = random.sample(range(len(self.callers)), 1)
-    medoids = [0]
+    rng = np.random.RandomState(random_state)
+    n = X.shape[0]
+    medoids = [rng.randint(n)]
+    D = np.asarray(X[:, medoids[0]], dtype=np.float64).ravel()
     while len(medoids) < n_clusters:
-        dist_mat = dist_from_centers(X, medoids)
-        medoids.append(choose_next_center(dist_mat))
+        cumdist = D.cumsum()
+        if cumdist[-1] > 0:
+            # points at distance 0 from a medoid (including the medoids) are never chosen
+            ind = min(int(np.searchsorted(cumdist, rng.random_sample() * cumdist[-1], side='right')), n - 1)
+        else:
+            # every point coincides with a medoid, so the remaining medoids are chosen uniformly
+            ind = rng.choice(np.setdiff1d(np.arange(n), medoids))
+        medoids.append(ind)
+        D = np.minimum(D, np.asarray(X[:, ind], dtype=np.float64).ravel())
     return medoids
 
 
-def kmedoids_update_clusters(X, n_clusters, medoid_ids, clusters_ids):
+def kmedoids_update_clusters(X, medoid_ids):
     """
     Updates clusters on each k-medoids iteration.
 
     :type X: numpy array
     :param X: the distance matrix to be used
-    :type n_clusters: int
-    :param n_clusters: the number of clusters
     :type medoid_ids: array like
     :param medoid_ids: the ids of the medoids
-    :type clusters_ids: dict
-    :param clusters_ids: clusters results, stored in dictionary
-    :return clusters_ids: updated clusters
+    :return labels: the cluster id (i.e. the position in medoid_ids) of the closest medoid of each data point
     """
-    # determine clusters, i.e. arrays of data indices
     # argmin returns the cluster id of the closest medoid
-    J = np.argmin(X[:, medoid_ids], axis=1)
-    #J[medoid_ids] = range(n_clusters)
+    return np.argmin(X[:, medoid_ids], axis=1)
 
-    for kappa in range(n_clusters):
-        clusters_ids[kappa] = np.where(J == kappa)[0]
 
-    return clusters_ids
+def kmedoids_update_clusters_bounded(X, medoid_ids, bounds):
+    """
+    Updates clusters on each k-medoids iteration like kmedoids_update_clusters, using the triangle inequality to skip
+    the data points whose closest medoid cannot have changed (Hamerly's bounds). For each data point, bounds keeps the
+    medoid to which it is assigned, an upper bound on its distance from that medoid and a lower bound on its distance
+    from any other medoid (see shift_bounds). A point is assigned to the same medoid if its upper bound is below its
+    lower bound or below half the distance of its medoid from the closest other medoid; otherwise its upper bound is
+    tightened, and only if that does not suffice is it compared with all the medoids. The first call compares all the
+    data points with all the medoids and initialises the bounds.
+
+    :type X: numpy array
+    :param X: the distance matrix to be used, which must satisfy the triangle inequality
+    :type medoid_ids: array like
+    :param medoid_ids: the sorted ids of the medoids
+    :type bounds: dictionary
+    :param bounds: {'tol'} and the {'assigned','upper','lower'} of the previous call, updated in place
+    :return labels: the cluster id (i.e. the position in medoid_ids) of the closest medoid of each data point
+    """
+    medoid_ids = np.asarray(medoid_ids, dtype=np.intp)
+    tol = bounds['tol']
+    if 'assigned' not in bounds:
+        check = np.arange(X.shape[0])
+        labels = np.zeros(X.shape[0], dtype=np.intp)
+        bounds['upper'] = np.zeros(X.shape[0])
+        bounds['lower'] = np.zeros(X.shape[0])
+    else:
+        labels = np.searchsorted(medoid_ids, bounds['assigned'])
+        medoid_dist = np.array(X[np.ix_(medoid_ids, medoid_ids)], dtype=np.float64)
+        np.fill_diagonal(medoid_dist, np.inf)
+        # a point closer to its medoid than half the distance of that medoid from any other medoid stays with it
+        limit = np.maximum(0.5 * (medoid_dist.min(axis=1) - tol)[labels], bounds['lower'])
+        check = np.flatnonzero(bounds['upper'] >= limit)
+        bounds['upper'][check] = X[check, medoid_ids[labels[check]]]
+        check = check[bounds['upper'][check] >= limit[check]]
+    if len(check) > 0:
+        dist = np.array(X[np.ix_(check, medoid_ids)], dtype=np.float64)
+        labels[check] = np.argmin(dist, axis=1)
+        bounds['upper'][check] = dist[np.arange(len(check)), labels[check]]
+        dist[np.arange(len(check)), labels[check]] = np.inf
+        bounds['lower'][check] = dist.min(axis=1) if len(medoid_ids) > 1 else np.inf
+    bounds['assigned'] = medoid_ids[labels]
+    return labels
 
 
-def kmedoids_update_medoids(X, n_clusters, medoid_ids, clusters_ids):
+def shift_bounds(X, bounds, medoid_ids, medoid_ids_new, labels):
     """
-    Updates medoids on each k-medoids iteration.
+    Updates the bounds of kmedoids_update_clusters_bounded after the medoids have moved: by the triangle inequality, the
+    distance of a data point from a medoid changes at most by the distance between the old and the new medoid.
+
+    :type X: numpy array
+    :param X: the distance matrix to be used
+    :type bounds: dictionary
+    :param bounds: the bounds of kmedoids_update_clusters_bounded, updated in place
+    :type medoid_ids: array like
+    :param medoid_ids: the ids of the old medoids
+    :type medoid_ids_new: array like
+    :param medoid_ids_new: the ids of the new medoids, in the order of the old ones
+    :type labels: array like
+    :param labels: the cluster id (i.e. the position in medoid_ids) of each data point
+    """
+    medoid_ids_new = np.asarray(medoid_ids_new, dtype=np.intp)
+    shift = np.asarray(X[np.asarray(medoid_ids, dtype=np.intp), medoid_ids_new], dtype=np.float64) + bounds['tol']
+    bounds['assigned'] = medoid_ids_new[labels]
+    bounds['upper'] += shift[labels]
+    # the lower bound is on the distance from the other medoids, so the shift of the assigned medoid does not count
+    largest = np.argmax(shift)
+    second = np.max(np.delete(shift, largest)) if len(shift) > 1 else 0.0
+    bounds['lower'] -= np.where(labels == largest, second, shift[largest])
+
+
+def triangle_tolerance(X):
+    """
+    Returns the amount by which the stored distances of a matrix may violate the triangle inequality because of their
+    precision, which kmedoids_update_clusters_bounded adds to each bound, so that rounding never changes a cluster.
+
+    :type X: numpy array
+    :param X: the distance matrix
+    :return: the tolerance
+    """
+    while isinstance(X, IndexedDistanceMatrix):
+        X = X.base
+    if isinstance(X, CondensedDistanceMatrix) and X.precision == 'uint16':
+        # each of the three distances is rounded to the closest level, or to the next one for distances close to 0 or 1
+        return 3.0 / X.levels
+    dtype = X.dtype if np.issubdtype(X.dtype, np.floating) else np.float64
+    return 4 * float(np.finfo(dtype).eps)
+
+
+def kmedoids_update_medoids(X, medoid_ids, labels, group_size=256, max_block=1 << 22):
+    """
+    Updates medoids on each k-medoids iteration, i.e. chooses the data point of each cluster with the smallest sum of
+    distances from the rest of the cluster (the first one, on ties). The data points are sorted by cluster, and the
+    sums are computed with grouped reductions (np.add.reduceat) over the sub-matrix of each group of consecutive small
+    clusters, of at most group_size data points, so that there is no Python loop per cluster; a larger cluster is a
+    group of its own, whose sub-matrix is read in blocks of rows of at most max_block distances. The medoid of an empty
+    cluster is kept.
 
     :type X: numpy array
     :param X: the distance matrix to be used
-    :type n_clusters: int
-    :param n_clusters: the number of clusters
     :type medoid_ids: array like
     :param medoid_ids: the ids of the medoids
-    :type clusters_ids: dict
-    :param clusters_ids: clusters results, stored in dictionary
+    :type labels: numpy array
+    :param labels: the cluster id of each data point (see kmedoids_update_clusters)
+    :type group_size: int
+    :param group_size: the maximum number of data points of a group of clusters
+    :type max_block: int
+    :param max_block: the maximum number of distances of each block
     :return medoid_ids: updated medoids
     """
-    # update medoids
-    for kappa in range(n_clusters):
-        J = np.mean(X[np.ix_(clusters_ids[kappa], clusters_ids[kappa])], axis=1)
-        j = np.argmin(J)
-        medoid_ids[kappa] = clusters_ids[kappa][j]
-
+    k = len(medoid_ids)
+    # the members of cluster kappa are order[bounds[kappa]:bounds[kappa + 1]], in increasing order
+    order = np.argsort(labels, kind='mergesort')
+    bounds = np.searchsorted(labels[order], np.arange(k + 1))
+    nonempty = np.flatnonzero(np.diff(bounds))
+    starts = bounds[nonempty]
+    # the position of the cluster of each data point among the non-empty clusters, in sorted order
+    segments = np.repeat(np.arange(len(nonempty)), np.diff(bounds)[nonempty])
+    costs = np.empty(len(order))
+    first = 0
+    while first < len(nonempty):
+        # a group of consecutive clusters, whose members are compared with the members of every cluster of the group
+        last = first + 1
+        while last < len(nonempty) and bounds[nonempty[last] + 1] - starts[first] <= group_size:
+            last += 1
+        lo, hi = starts[first], bounds[nonempty[last - 1] + 1]
+        cols = order[lo:hi]
+        block_rows = max(1, max_block // len(cols))
+        for r0 in range(lo, hi, block_rows):
+            r1 = min(r0 + block_rows, hi)
+            sums = np.add.reduceat(np.asarray(X[np.ix_(order[r0:r1], cols)], dtype=np.float64),
+                                   starts[first:last] - lo, axis=1)
+            costs[r0:r1] = sums[np.arange(r1 - r0), segments[r0:r1] - first]
+        first = last
+    # the first member of each cluster with the smallest cost
+    mins = np.minimum.reduceat(costs, starts) if len(starts) else costs
+    candidates = np.flatnonzero(costs == mins[segments])
+    _, firsts = np.unique(segments[candidates], return_index=True)
+    medoid_ids = np.array(medoid_ids, dtype=np.intp)
+    medoid_ids[nonempty] = order[candidates[firsts]]
     return medoid_ids
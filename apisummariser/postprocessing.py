@@ -1,5 +1,6 @@
 from Queue import heapq
 import numpy as np
+from scipy.sparse import issparse
 
 
 def get_top_callers(clusterer, params):
@@ -26,7 +27,7 @@ def get_top_callers(clusterer, params):
 
         if params['mode'] == 'identical':
             for m in clusterer.clusters_ids[c_id]:
-                if clusterer.dist_mat[medoid][int(m)] == 0.0:
+                if clusterer.dist_mat[medoid, int(m)] == 0.0:
                     tops_cluster.append({'dist': 0.0, 'caller': clusterer.callers[int(m)], 'id': int(m)})
                     if len(tops_cluster) == params['n']:
                         break
@@ -35,9 +36,12 @@ def get_top_callers(clusterer, params):
             for m in clusterer.clusters_ids[c_id]:
             # the negative sign is used in order to to convert heapq to min heap
                 if params['center'] == 'medoid':
-                    neg_dist = -clusterer.dist_mat[medoid][int(m)]
+                    neg_dist = -clusterer.dist_mat[medoid, int(m)]
                 elif params['center'] == 'centroid':
-                    neg_dist = -np.linalg.norm(clusterer.f_vector[int(m)]-centroid)
+                    vec = clusterer.f_vector[int(m)]
+                    if issparse(vec):
+                        vec = vec.toarray().ravel()
+                    neg_dist = -np.linalg.norm(vec-centroid)
                 else:
                     raise NotImplementedError
                 if len(tops_cluster) < params['n']:
@@ -1,8 +1,18 @@
+import os
+import tempfile
+from collections import Counter
+from itertools import count, izip
+from multiprocessing import Pool, cpu_count
+
 import numpy as np
+from scipy.sparse import csr_matrix
 from sklearn import manifold
 from tqdm import tqdm
 
-from apisummariser.helper import sequences_metrics
+from apisummariser.helper import cache, filefunctions, minhash, sequences_metrics, session
+from apisummariser.helper.corpus import SequenceCorpus, sequence_keys, take_sequences
+from apisummariser.helper.distance_matrix import CondensedDistanceMatrix, DistanceMatrix, IndexedDistanceMatrix, \
+    SparseDistanceMatrix, condensed_size
 
 
 class Preprocessor:
@@ -11,13 +21,15 @@ class Preprocessor:
         '''
         :type callers: list
         :param callers: a list of caller methods
-        :type calls: list of lists
+        :type calls: list of lists or SequenceCorpus
         :param calls: a list of method call sequences
         '''
         self.callers_file = callers_file
         self.callers_package = callers_package
         self.callers = callers
         self.calls = calls
+        self.lcs_lens = None
+        self.lcs_lens_key = None
 
 
     def perform_preprocessing(self, mode, params):
@@ -27,16 +39,16 @@ class Preprocessor:
         :type mode: string
         :param mode: ['vector', 'distance']
         :type params: dictionary
-        :param params: {'metric','remove_singletons','remove_pseudo_singletons','remove_unique'}
+        :param params: {'metric','remove_singletons','remove_pseudo_singletons','remove_unique'} and the optional
+        parameters of compute_distances (or create_vector, for the 'vector' mode)
         """
         params_clean = {'remove_singletons':params['remove_singletons'],
                         'remove_pseudo_singletons':params['remove_pseudo_singletons']}
         self.clean_data(params_clean)
         if mode == 'vector':
-            self.create_vector()
+            self.create_vector(params)
         elif mode == 'distance':
-            dist_func = self.get_dist_func(params['metric'])
-            self.compute_similarity(dist_func)
+            self.compute_distances(params)
             if params['remove_unique']:
                 self.remove_outliers()
         else:
@@ -46,44 +58,21 @@ class Preprocessor:
     def clean_data(self, params):
         """
         Cleans the dataset, based on the specified option. Note that the 'remove_pseudo_singletons' option should be
-        combined with the 'remove_singletons' one.
+        combined with the 'remove_singletons' one. The sequences of a SequenceCorpus are checked in their integer form,
+        and the kept ones are taken from the corpus at once.
 
         :type params: dictionary
         :param params: {'remove_singletons','remove_pseudo_singletons'}
         """
-        upd_callers_file = []
-        upd_callers_package = []
-        upd_callers = []
-        upd_calls = []
-
-        for i in range(len(self.calls)):
-            # remove duplicate callers and sequences with single/identical API calls (includes singleton sequences)
-            if self.callers[i] not in upd_callers:
-                if params['remove_singletons']:
-                    if params['remove_pseudo_singletons']:
-                        if self.calls[i].count(self.calls[i][0]) != len(self.calls[i]):
-                            upd_callers_file.append(self.callers_file[i])
-                            upd_callers_package.append(self.callers_package[i])
-                            upd_callers.append(self.callers[i])
-                            upd_calls.append(self.calls[i])
-                    else:
-                        if self.calls[i] > 1:
-                            upd_callers_file.append(self.callers_file[i])
-                            upd_callers_package.append(self.callers_package[i])
-                            upd_callers.append(self.callers[i])
-                            upd_calls.append(self.calls[i])
-                else:
-                    upd_callers_file.append(self.callers_file[i])
-                    upd_callers_package.append(self.callers_package[i])
-                    upd_callers.append(self.callers[i])
-                    upd_calls.append(self.calls[i])
-        self.callers_file = upd_callers_file
-        self.callers_package = upd_callers_package
-        self.callers = upd_callers
-        self.calls = upd_calls
+        seqs = self.calls.encoded() if isinstance(self.calls, SequenceCorpus) else self.calls
+        records = clean_records(izip(self.callers_file, self.callers_package, self.callers, seqs, count()), params)
+        columns = zip(*records) or [(), (), (), (), ()]
+        self.callers_file, self.callers_package, self.callers = [list(column) for column in columns[:3]]
+        self.calls = take_sequences(self.calls, columns[4])
 
 
-    def get_dist_func(self, metric):
+    @staticmethod
+    def get_dist_func(metric):
         """
         Gets an instance of the function that will be used for computing sequence similarity.
 
@@ -122,29 +111,223 @@ class Preprocessor:
         :type dist_func: function
         :param dist_func: an instance of the distance function to be used
         """
-        self.dist_mat = np.zeros((len(self.calls), len(self.calls)))
-        for i in tqdm(range(len(self.calls))):
-            for j in range(i + 1):
-                self.dist_mat[i][j] = dist_func(self.calls[i], self.calls[j])
-                self.dist_mat[j][i] = self.dist_mat[i][j]
+        self.dist_mat = similarity_matrix(self.calls, dist_func)
+
+
+    def compute_lcs_similarity(self, metric):
+        """
+        Creates a distance matrix for one of the LCS-based metrics, using the bit-parallel LCS algorithm. The distances
+        are identical to the ones computed by compute_similarity.
+
+        :type metric: string
+        :param metric: ['lcs', 'lcs-mod', 'lcs-min', 'lcs-ext']
+        """
+        self.dist_mat = lcs_similarity_matrix(self.calls, metric)
+
+
+    def compute_distances(self, params):
+        """
+        Creates the distance matrix, using the engine and the options specified in params:
+            - engine: ['bulk', 'pairwise'], where 'bulk' computes the LCS-based metrics with the bit-parallel LCS
+            algorithm and the Jaccard metrics with products of a sparse incidence matrix, and 'pairwise' calls the
+            distance function for each pair (default: 'bulk')
+            - unique: if True, distances are only computed between distinct sequences. Sequences are hashed, and the
+            resulting matrix is a full-size view of the distinct sequences' matrix through an inverse index (see
+            IndexedDistanceMatrix). Note that the 'gestalt' metric is not symmetric, so a few of its distances may be
+            computed in the opposite direction (default: False)
+            - n_jobs: the number of worker processes, -1 uses all cores (default: 1). The workers write the matrix to a
+            temporary memory-mapped file in cache_dir, or in the system temporary directory if there is no cache_dir
+            (see parallel_distance_matrix)
+            - tile_size: the size of the tiles of the matrix that are assigned to the worker processes (default: 256)
+            - storage: ['dense', 'condensed'], whether the matrix is stored as a dense n x n array or as a
+            CondensedDistanceMatrix, which only stores the lower triangle with reduced precision (default: 'dense')
+            - precision: ['float32', 'uint16'], the precision of a condensed matrix (default: 'float32')
+            - sparse: if True, an inverted index from API calls to sequences is used to only evaluate the pairs of
+            sequences that share at least one API call, since any other pair is at distance 1.0 for every supported
+            metric. The result is a SparseDistanceMatrix, which DBSCAN and HDBSCAN consume as a sparse graph; it cannot
+            be combined with 'unique' (default: False)
+            - eps: with 'sparse', only distances that do not exceed eps are stored, which makes the graph even sparser
+            for density-based clustering with eps < 1.0. The LCS-based and the 'levenshtein' metrics then skip the
+            pairs whose lengths rule out a distance within eps, and the 'pairwise' engine stops their DP as soon as
+            eps is exceeded. The pruned pairs are reported at distance 1.0, which may change the selection of the
+            cluster centers (see sparse_distance_graph) (default: None)
+            - candidates: ['postings', 'lsh'], how 'sparse' finds the pairs that are evaluated. 'postings' evaluates
+            every pair that shares an API call, while 'lsh' only evaluates the pairs whose MinHash signatures collide in
+            at least one band, which scales to large corpora at the cost of missing a few near pairs (default:
+            'postings')
+            - bands, rows: with 'lsh', the number of bands and of hash values per band. More bands increase the recall
+            and more rows decrease the number of candidates (default: 16, 4)
+            - shingle: with 'lsh', the size of the n-grams of API calls that are hashed, where 1 hashes the set of API
+            calls of each sequence (default: 1)
+            - random_state: with 'lsh', the seed of the hash functions (default: 0)
+            - shared_lcs: if True, the LCS-based metrics are derived from the matrix of the lengths of the LCS, which is
+            computed once and shared by all of them (see compute_lcs_lengths), so that sweeping over the LCS-based
+            metrics costs a single LCS pass. With 'unique', the lengths are only computed between distinct sequences.
+            It is ignored with 'sparse' (default: False)
+            - session_dir: the directory of an incremental session (see update_distances); it takes precedence over
+            the cache and cannot be combined with 'unique' or 'sparse' (default: None)
+            - cache_dir: the directory of a persistent cache of distance matrices, keyed by a hash of the cleaned
+            sequences, the metric and the preprocessing parameters. Cached matrices are memory-mapped. It also holds
+            the temporary matrix of the worker processes of n_jobs (default: None, i.e. no cache)
+            - cache_size: the maximum size of the cache in bytes; the least recently used matrices are evicted first
+            (default: 10 GB)
+
+        :type params: dictionary
+        :param params: {'metric'} and the optional {'engine','unique','n_jobs','tile_size','storage','precision',
+        'sparse','eps','candidates','bands','rows','shingle','random_state','shared_lcs','session_dir','cache_dir',
+        'cache_size'}
+        """
+        if params.get('session_dir') is not None:
+            self.update_distances(params)
+            return
+
+        cache_dir = params.get('cache_dir')
+        if cache_dir is not None:
+            key = cache.cache_key(self.calls, params)
+            self.dist_mat = cache.load_distance_matrix(cache_dir, key)
+            if self.dist_mat is not None:
+                print 'Distance matrix loaded from cache: ' + key
+                return
+
+        if params.get('sparse', False):
+            if params.get('unique', False):
+                raise NotImplementedError
+            self.dist_mat = sparse_distance_graph(self.calls, params)
+        elif params.get('shared_lcs', False) and params['metric'] in sequences_metrics.LCS_METRICS:
+            if params.get('unique', False):
+                seq_index, unique_calls = unique_sequences(self.calls)
+                print 'Distinct sequences: ' + str(len(unique_calls))
+                self.compute_lcs_lengths(params, unique_calls)
+            else:
+                self.compute_lcs_lengths(params)
+            dist_mat = allocate_distance_matrix(len(self.lcs_lens), params.get('storage', 'dense'),
+                                                params.get('precision', 'float32'))
+            self.dist_mat = lcs_metric_matrix(self.lcs_lens, params['metric'], dist_mat)
+            if params.get('unique', False):
+                self.dist_mat = IndexedDistanceMatrix(self.dist_mat, seq_index)
+        elif params.get('unique', False):
+            seq_index, unique_calls = unique_sequences(self.calls)
+            print 'Distinct sequences: ' + str(len(unique_calls))
+            self.dist_mat = IndexedDistanceMatrix(build_distance_matrix(unique_calls, params), seq_index)
+        else:
+            self.dist_mat = build_distance_matrix(self.calls, params)
+
+        if cache_dir is not None:
+            cache.store_distance_matrix(cache_dir, key, self.dist_mat, params.get('cache_size', 10 * 1024 ** 3))
+
+
+    def compute_lcs_lengths(self, params, calls=None):
+        """
+        Computes the matrix of the lengths of the LCS between the current sequences (see lcs_length_matrix), unless it
+        has already been computed for the same sequences. If a cache directory is given, the matrix is also stored in
+        the cache, keyed by a hash of the sequences only, so that it persists across runs.
+
+        :type params: dictionary
+        :param params: the optional {'cache_dir','cache_size'}
+        :type calls: list of lists or SequenceCorpus
+        :param calls: the sequences, e.g. the distinct ones of the current sequences (default: the current sequences)
+        """
+        if calls is None:
+            calls = self.calls
+        key = cache.cache_key(calls, {'metric': 'lcs-length'})
+        if self.lcs_lens is not None and self.lcs_lens_key == key:
+            return
+        cache_dir = params.get('cache_dir')
+        self.lcs_lens = None
+        if cache_dir is not None:
+            self.lcs_lens = cache.load_distance_matrix(cache_dir, key)
+        if self.lcs_lens is None:
+            self.lcs_lens = lcs_length_matrix(calls)
+            if cache_dir is not None:
+                cache.store_distance_matrix(cache_dir, key, self.lcs_lens, params.get('cache_size', 10 * 1024 ** 3))
+        self.lcs_lens_key = key
+
+
+    def update_distances(self, params):
+        """
+        Creates the distance matrix incrementally, using the session stored in params['session_dir'] by a previous run.
+        The callers of the previous session keep their ids and the new callers are appended, so that only the rows (and
+        columns) of the new callers, as well as of any callers whose calls have changed, are computed. The stored
+        matrix is extended in place and memory-mapped. If there is no previous session, the full matrix is computed
+        and stored as a new session.
+
+        :type params: dictionary
+        :param params: {'metric','session_dir'} and the optional {'engine','n_jobs','tile_size','storage','precision'}
+        """
+        if params.get('unique', False) or params.get('sparse', False):
+            raise NotImplementedError
+        session_dir = params['session_dir']
+        meta = {'metric': params['metric'], 'storage': params.get('storage', 'dense'),
+                'precision': params.get('precision', 'float32')}
+        prev_callers, prev_calls, prev_meta = session.load_session(session_dir)
+        if prev_callers is None:
+            meta['n'] = len(self.calls)
+            session.save_session(session_dir, self.callers, self.calls, meta, build_distance_matrix(self.calls, params))
+            self.dist_mat = session.open_matrix(session_dir, meta)
+            return
+        if any(prev_meta[key] != meta[key] for key in ['metric', 'storage', 'precision']):
+            raise ValueError('the parameters do not match the ones of the session in ' + session_dir)
+
+        n_old = self.reorder_callers(prev_callers)
+        changed = [i for i in range(n_old) if self.calls[i] != prev_calls[i]]
+        print 'New callers: ' + str(len(self.calls) - n_old) + ', changed callers: ' + str(len(changed))
+        self.dist_mat = session.open_matrix(session_dir, prev_meta, len(self.calls))
+        row_func = distance_row_func(self.calls, params['metric'], params.get('engine', 'bulk'))
+        for i in tqdm(range(n_old, len(self.calls))):
+            store_row(self.dist_mat, i, 0, row_func(i, range(i + 1)))
+        changed_set = set(changed)
+        for i in changed:
+            store_row(self.dist_mat, i, 0, row_func(i, range(i + 1)))
+            # the pairs (j, i) of the changed callers j > i are stored by the row of j
+            for j in range(i + 1, n_old):
+                if j not in changed_set:
+                    store_row(self.dist_mat, j, i, row_func(j, [i]))
+        (self.dist_mat.data if isinstance(self.dist_mat, CondensedDistanceMatrix) else self.dist_mat).flush()
+        meta['n'] = len(self.calls)
+        session.save_session(session_dir, self.callers, self.calls, meta)
+
+
+    def reorder_callers(self, prev_callers):
+        """
+        Reorders the cleaned data, so that the callers of a previous session come first, in their previous order,
+        followed by any new callers.
+
+        :type prev_callers: list
+        :param prev_callers: the cleaned callers of the previous session
+        :return n_old: the number of callers of the previous session
+        """
+        positions = dict((caller, i) for i, caller in enumerate(self.callers))
+        missing = [caller for caller in prev_callers if caller not in positions]
+        if missing:
+            raise ValueError(str(len(missing)) + ' callers of the previous session are missing, e.g. ' + missing[0])
+        order = [positions[caller] for caller in prev_callers]
+        prev_ids = set(order)
+        order.extend(i for i in range(len(self.callers)) if i not in prev_ids)
+        self.callers_file = [self.callers_file[i] for i in order]
+        self.callers_package = [self.callers_package[i] for i in order]
+        self.callers = [self.callers[i] for i in order]
+        self.calls = take_sequences(self.calls, order)
+        return len(prev_callers)
 
 
     def remove_outliers(self):
         """
-        Currently removes sequences that are unique. It makes use of the distance matrix, for efficiency reasons.
-        This could be easily avoided by a brute-force solution.
-        """
-        ind_to_remove = []
-        for i in range(len(self.callers)):
-            if np.count_nonzero(self.dist_mat[i] == 0.0) == 1:
-                ind_to_remove.append(i)
-        self.dist_mat = np.delete(self.dist_mat, ind_to_remove, axis=0)
-        self.dist_mat = np.delete(self.dist_mat, ind_to_remove, axis=1)
-        for i in reversed(ind_to_remove):
-            self.callers_file.pop(i)
-            self.callers_package.pop(i)
-            self.callers.pop(i)
-            self.calls.pop(i)
+        Currently removes sequences that are unique, i.e. that no other caller invokes. The sequences are counted in a
+        hash table, and the distance matrix is compacted in place when it is an in-memory array, so that it is never
+        copied.
+        """
+        keys = sequence_keys(self.calls)
+        counts = Counter(keys)
+        keep = [i for i in range(len(keys)) if counts[keys[i]] > 1]
+        if len(keep) < len(self.calls):
+            if isinstance(self.dist_mat, DistanceMatrix):
+                self.dist_mat = self.dist_mat.take(keep)
+            else:
+                self.dist_mat = compact_matrix(self.dist_mat, keep)
+            self.callers_file = [self.callers_file[i] for i in keep]
+            self.callers_package = [self.callers_package[i] for i in keep]
+            self.callers = [self.callers[i] for i in keep]
+            self.calls = take_sequences(self.calls, keep)
         print 'Data points after removing outliers: ' + str(len(self.callers))
 
 
@@ -161,22 +344,23 @@ class Preprocessor:
         self.f_vector = model.fit_transform(self.dist_mat)
 
 
-    def create_vector(self):
+    def create_vector(self, params=None):
         """
         Generate feature vectors, using the API method calls as features. THis does not take into account the order in
-        which the API methods are invoked.
+        which the API methods are invoked. The feature vectors are stored as a sparse scipy CSR matrix, whose columns
+        follow the order of self.calls_set.
+
+        :type params: dictionary
+        :param params: {'weighting'}, where 'binary' marks the API calls that each caller invokes and 'tf' counts their
+        invocations (default: 'binary')
         """
-        self.calls_set = set()
-        for calls in self.calls:
-            self.calls_set.update(calls)
-        self.calls_set = list(self.calls_set)
-        self.f_vector = np.zeros((len(self.callers), len(self.calls_set)))
-        print len(self.f_vector)
-        for caller_id in range(len(self.callers)):
-            for call_id in range(len(self.calls_set)):
-                if self.calls_set[int(call_id)] in self.calls[int(caller_id)]:
-                    self.f_vector[int(caller_id)][int(call_id)] = 1
-        print 'Non-zero elements:' + str(np.count_nonzero(self.f_vector))
+        if params is None:
+            params = {}
+        incidence, vocabulary = incidence_matrix(self.calls, params.get('weighting', 'binary'))
+        self.calls_set = sorted(vocabulary, key=vocabulary.get)
+        self.f_vector = incidence.astype(np.float64)
+        print self.f_vector.shape[0]
+        print 'Non-zero elements:' + str(self.f_vector.nnz)
 
 
     def freq_idx(self):
@@ -198,4 +382,625 @@ class Preprocessor:
         for call in self.calls:
             if call not in non_identical_calls:
                 non_identical_calls.append(call)
-        return non_identical_calls
\ No newline at end of file
+        return non_identical_calls
+
+
+def clean_records(records, params):
+    """
+    Filters a stream of caller records, removing duplicate callers (only the first valid record of each caller is kept)
+    and, based on the specified options, sequences with single/identical API calls. Callers are tracked in a hash set,
+    so that the stream is filtered in linear time.
+
+    :type records: iterable
+    :param records: tuples that start with (caller file, caller package, caller, calls)
+    :type params: dictionary
+    :param params: {'remove_singletons','remove_pseudo_singletons'}
+    :return: a generator of the records that are kept
+    """
+    seen_callers = set()
+    for record in records:
+        caller, calls = record[2], record[3]
+        # remove duplicate callers and sequences with single/identical API calls (includes singleton sequences)
+        if caller in seen_callers:
+            continue
+        if params['remove_singletons']:
+            if params['remove_pseudo_singletons']:
+                keep = calls.count(calls[0]) != len(calls)
+            else:
+                keep = calls > 1
+        else:
+            keep = True
+        if keep:
+            seen_callers.add(caller)
+            yield record
+
+
+def compact_matrix(dist_mat, keep):
+    """
+    Returns the distance matrix of the kept data points. An in-memory, contiguous numpy array is compacted in place,
+    i.e. the kept rows are moved to the beginning of its buffer, and the result is a view of that buffer; any other
+    array (e.g. a memory-mapped matrix of a cache or a session, which must not be modified) is copied once.
+
+    :type dist_mat: numpy array
+    :param dist_mat: the distance matrix
+    :type keep: list
+    :param keep: the sorted ids of the data points to be kept
+    :return: the m x m distance matrix of the kept data points
+    """
+    keep = np.asarray(keep, dtype=np.intp)
+    if type(dist_mat) is not np.ndarray or not dist_mat.flags.c_contiguous or not dist_mat.flags.writeable:
+        return dist_mat[np.ix_(keep, keep)]
+    n = dist_mat.shape[0]
+    m = len(keep)
+    flat = dist_mat.reshape(-1)
+    # row r is written to flat[r * m:(r + 1) * m], which never overlaps the rows keep[r + 1:] that are still to be read
+    for r in range(m):
+        flat[r * m:(r + 1) * m] = flat[keep[r] * n + keep]
+    return flat[:m * m].reshape(m, m)
+
+
+def unique_sequences(calls):
+    """
+    Hashes the sequences and finds the distinct ones.
+
+    :type calls: list of lists or SequenceCorpus
+    :param calls: a list of method call sequences
+    :return seq_index: a numpy array with the id of the distinct sequence of each sequence
+    :return unique_calls: the distinct sequences, in order of first appearance (of the same type as calls)
+    """
+    seq_ids = {}
+    unique_ids = []
+    seq_index = np.empty(len(calls), dtype=np.intp)
+    for i, key in enumerate(sequence_keys(calls)):
+        seq_id = seq_ids.get(key)
+        if seq_id is None:
+            seq_id = len(unique_ids)
+            seq_ids[key] = seq_id
+            unique_ids.append(i)
+        seq_index[i] = seq_id
+    return seq_index, take_sequences(calls, unique_ids)
+
+
+def build_distance_matrix(calls, params):
+    """
+    Computes the distance matrix of a list of sequences, using the appropriate engine for the given metric.
+
+    :type calls: list of lists or SequenceCorpus
+    :param calls: a list of method call sequences
+    :type params: dictionary
+    :param params: {'metric'} and the optional {'engine','n_jobs','tile_size','storage','precision','cache_dir'} (see
+    Preprocessor.compute_distances)
+    :return dist_mat: the distance matrix
+    """
+    metric = params['metric']
+    engine = params.get('engine', 'bulk')
+    if engine not in ['bulk', 'pairwise']:
+        raise NotImplementedError
+    storage = params.get('storage', 'dense')
+    precision = params.get('precision', 'float32')
+    if engine == 'bulk' and metric in sequences_metrics.JACCARD_METRICS:
+        return jaccard_similarity_matrix(calls, metric, allocate_distance_matrix(len(calls), storage, precision))
+    n_jobs = params.get('n_jobs', 1)
+    if n_jobs != 1:
+        return parallel_distance_matrix(calls, metric, engine, n_jobs, params.get('tile_size', 256), storage,
+                                        precision, params.get('cache_dir'))
+    dist_mat = allocate_distance_matrix(len(calls), storage, precision)
+    if engine == 'bulk' and metric in sequences_metrics.LCS_METRICS:
+        return lcs_similarity_matrix(calls, metric, dist_mat)
+    elif engine == 'bulk' and metric in sequences_metrics.PREPARED_METRICS:
+        return prepared_similarity_matrix(calls, metric, dist_mat)
+    else:
+        return similarity_matrix(calls, Preprocessor.get_dist_func(metric), dist_mat)
+
+
+def allocate_distance_matrix(n, storage, precision, mmap_path=None, mode='w+'):
+    """
+    Allocates the distance matrix of n data points, which is initially filled with zeros, optionally backed by a
+    memory-mapped file.
+
+    :type n: int
+    :param n: the number of data points
+    :type storage: string
+    :param storage: ['dense', 'condensed']
+    :type precision: string
+    :param precision: ['float32', 'uint16'], only used by condensed matrices
+    :type mmap_path: str
+    :param mmap_path: the path of the file that backs the matrix, if any
+    :type mode: string
+    :param mode: the numpy memmap mode used to open the file
+    :return dist_mat: a numpy array (or memmap) or a CondensedDistanceMatrix
+    """
+    if storage == 'dense':
+        if mmap_path is None or n == 0:
+            return np.zeros((n, n))
+        return np.memmap(mmap_path, dtype=np.float64, mode=mode, shape=(n, n))
+    elif storage == 'condensed':
+        data = None
+        if mmap_path is not None and condensed_size(n) > 0:
+            data = np.memmap(mmap_path, dtype=CondensedDistanceMatrix.storage_dtypes[precision], mode=mode,
+                             shape=(condensed_size(n),))
+        return CondensedDistanceMatrix(n, precision, data)
+    else:
+        raise NotImplementedError
+
+
+def store_row(dist_mat, i, j0, row):
+    """
+    Stores the distances between sequence i and sequences j0, j0 + 1, ..., j0 + len(row) - 1 (where j0 + len(row) - 1
+    <= i), along with their symmetric ones.
+
+    :type dist_mat: numpy array or CondensedDistanceMatrix
+    :param dist_mat: the distance matrix
+    :type i: int
+    :param i: the id of the sequence
+    :type j0: int
+    :param j0: the id of the first sequence of the row
+    :type row: list
+    :param row: the distances
+    """
+    if isinstance(dist_mat, CondensedDistanceMatrix):
+        dist_mat.set_row(i, j0, row)
+    else:
+        dist_mat[i, j0:j0 + len(row)] = row
+        dist_mat[j0:j0 + len(row), i] = row
+
+
+def similarity_matrix(calls, dist_func, dist_mat=None):
+    """
+    Computes the distance matrix of a list of sequences by calling the distance function for each pair. API calls are
+    mapped to integer ids once, since every metric only compares API calls for equality.
+
+    :type calls: list of lists or SequenceCorpus
+    :param calls: a list of method call sequences
+    :type dist_func: function
+    :param dist_func: an instance of the distance function to be used
+    :type dist_mat: numpy array or CondensedDistanceMatrix
+    :param dist_mat: the matrix where the distances are stored (default: a new dense matrix)
+    :return dist_mat: the distance matrix
+    """
+    _, calls = sequences_metrics.encode_sequences(calls)
+    if dist_mat is None:
+        dist_mat = np.zeros((len(calls), len(calls)))
+    for i in tqdm(range(len(calls))):
+        store_row(dist_mat, i, 0, [dist_func(calls[i], calls[j]) for j in range(i + 1)])
+    return dist_mat
+
+
+def lcs_similarity_matrix(calls, metric, dist_mat=None):
+    """
+    Computes the distance matrix of a list of sequences for one of the LCS-based metrics, using the bit-parallel LCS
+    algorithm. API calls are mapped to integer ids once, and the lengths of the LCS are computed in bulk for each row.
+
+    :type calls: list of lists or SequenceCorpus
+    :param calls: a list of method call sequences
+    :type metric: string
+    :param metric: ['lcs', 'lcs-mod', 'lcs-min', 'lcs-ext']
+    :type dist_mat: numpy array or CondensedDistanceMatrix
+    :param dist_mat: the matrix where the distances are stored (default: a new dense matrix)
+    :return dist_mat: the distance matrix
+    """
+    from_len = sequences_metrics.LCS_METRICS[metric]
+    _, enc_calls = sequences_metrics.encode_sequences(calls)
+    lens = np.array([len(seq) for seq in enc_calls])
+    if dist_mat is None:
+        dist_mat = np.zeros((len(enc_calls), len(enc_calls)))
+    for i in tqdm(range(len(enc_calls))):
+        lcss = np.array(sequences_metrics.lcs_len_bulk(enc_calls[i], enc_calls[:i + 1]))
+        store_row(dist_mat, i, 0, from_len(lcss, lens[i], lens[:i + 1]))
+    return dist_mat
+
+
+def prepared_similarity_matrix(calls, metric, dist_mat=None):
+    """
+    Computes the distance matrix of a list of sequences for one of the metrics that preprocess each sequence once (see
+    sequences_metrics.PREPARED_METRICS), so that each pair only compares the preprocessed sequences. The distances are
+    identical to the ones computed by similarity_matrix.
+
+    :type calls: list of lists or SequenceCorpus
+    :param calls: a list of method call sequences
+    :type metric: string
+    :param metric: ['seqsim', 'gestalt']
+    :type dist_mat: numpy array or CondensedDistanceMatrix
+    :param dist_mat: the matrix where the distances are stored (default: a new dense matrix)
+    :return dist_mat: the distance matrix
+    """
+    prepare, prepared_dist = sequences_metrics.PREPARED_METRICS[metric]
+    _, calls = sequences_metrics.encode_sequences(calls)
+    prepared = prepare(calls)
+    if dist_mat is None:
+        dist_mat = np.zeros((len(calls), len(calls)))
+    for i in tqdm(range(len(calls))):
+        store_row(dist_mat, i, 0, [prepared_dist(prepared[i], prepared[j]) for j in range(i + 1)])
+    return dist_mat
+
+
+def lcs_length_matrix(calls):
+    """
+    Computes the matrix of the lengths of the LCS between every pair of sequences, using the bit-parallel LCS algorithm.
+    Its diagonal holds the lengths of the sequences, so that every LCS-based distance matrix can be derived from it
+    alone (see lcs_metric_matrix).
+
+    :type calls: list of lists or SequenceCorpus
+    :param calls: a list of method call sequences
+    :return lcs_lens: a symmetric n x n numpy array of int32
+    """
+    _, enc_calls = sequences_metrics.encode_sequences(calls)
+    lcs_lens = np.zeros((len(enc_calls), len(enc_calls)), dtype=np.int32)
+    for i in tqdm(range(len(enc_calls))):
+        lcss = sequences_metrics.lcs_len_bulk(enc_calls[i], enc_calls[:i + 1])
+        lcs_lens[i, :i + 1] = lcss
+        lcs_lens[:i + 1, i] = lcss
+    return lcs_lens
+
+
+def lcs_metric_matrix(lcs_lens, metric, dist_mat=None, block_size=1024):
+    """
+    Derives the distance matrix of one of the LCS-based metrics from the matrix of the lengths of the LCS, by
+    evaluating the closed-form distance for blocks of rows with numpy. The distances are identical to the ones computed
+    by lcs_similarity_matrix.
+
+    :type lcs_lens: numpy array
+    :param lcs_lens: the lengths of the LCS, as computed by lcs_length_matrix
+    :type metric: string
+    :param metric: ['lcs', 'lcs-mod', 'lcs-min', 'lcs-ext']
+    :type dist_mat: numpy array or CondensedDistanceMatrix
+    :param dist_mat: the matrix where the distances are stored (default: a new dense matrix)
+    :type block_size: int
+    :param block_size: the number of rows of each block
+    :return dist_mat: the distance matrix
+    """
+    from_len = sequences_metrics.LCS_METRICS[metric]
+    n = len(lcs_lens)
+    lens = np.asarray(lcs_lens.diagonal(), dtype=np.int64)
+    if dist_mat is None:
+        dist_mat = np.zeros((n, n))
+    for r0 in range(0, n, block_size):
+        r1 = min(r0 + block_size, n)
+        block = from_len(np.asarray(lcs_lens[r0:r1, :r1], dtype=np.int64), lens[r0:r1, np.newaxis], lens[:r1])
+        for i in range(r0, r1):
+            store_row(dist_mat, i, 0, block[i - r0, :i + 1])
+    return dist_mat
+
+
+def incidence_matrix(calls, weighting='binary'):
+    """
+    Builds the sparse incidence matrix of a list of sequences, i.e. a (sequences x distinct API calls) matrix whose
+    (i, c) element is 1 if sequence i contains API call c ('binary'), or the number of times that sequence i invokes API
+    call c ('tf'). The matrix is built in a single pass over the sequences.
+
+    :type calls: list of lists or SequenceCorpus
+    :param calls: a list of method call sequences
+    :type weighting: string
+    :param weighting: ['binary', 'tf']
+    :return incidence: a scipy csr_matrix of int32
+    :return vocabulary: a dictionary that maps each API call to its column
+    """
+    if weighting not in ['binary', 'tf']:
+        raise NotImplementedError
+    vocabulary, enc_calls = sequences_metrics.encode_sequences(calls)
+    indptr = [0]
+    indices = []
+    for seq in enc_calls:
+        indices.extend(sorted(set(seq)) if weighting == 'binary' else seq)
+        indptr.append(len(indices))
+    incidence = csr_matrix((np.ones(len(indices), dtype=np.int32), indices, indptr),
+                           shape=(len(calls), len(vocabulary)))
+    # the repeated calls of a sequence are summed to their frequency
+    incidence.sum_duplicates()
+    return incidence, vocabulary
+
+
+def jaccard_similarity_matrix(calls, metric, dist_mat=None, block_size=1024):
+    """
+    Computes the distance matrix of a list of sequences for one of the Jaccard-based metrics. The sizes of all the
+    pairwise intersections are given by the product of the sparse incidence matrix with its transpose, which is computed
+    for blocks of rows, and the sizes of the sets are its row sums. The distances are identical to the ones of
+    sequences_metrics.jaccard and sequences_metrics.jaccard_min.
+
+    :type calls: list of lists or SequenceCorpus
+    :param calls: a list of method call sequences
+    :type metric: string
+    :param metric: ['jaccard', 'jaccard-min']
+    :type dist_mat: numpy array or CondensedDistanceMatrix
+    :param dist_mat: the matrix where the distances are stored (default: a new dense matrix)
+    :type block_size: int
+    :param block_size: the number of rows of each block
+    :return dist_mat: the distance matrix
+    """
+    from_counts = sequences_metrics.JACCARD_METRICS[metric]
+    incidence, _ = incidence_matrix(calls)
+    set_sizes = np.asarray(incidence.sum(axis=1)).ravel()
+    incidence_t = incidence.T.tocsr()
+    if dist_mat is None:
+        dist_mat = np.zeros((len(calls), len(calls)))
+    for r0 in tqdm(range(0, len(calls), block_size)):
+        r1 = min(r0 + block_size, len(calls))
+        inter = (incidence[r0:r1] * incidence_t[:, :r1]).toarray()
+        for i in range(r0, r1):
+            store_row(dist_mat, i, 0, from_counts(inter[i - r0, :i + 1], set_sizes[i], set_sizes[:i + 1]))
+    return dist_mat
+
+
+def sparse_jaccard_graph(calls, metric, max_dist):
+    """
+    Computes the sparse distance graph of a list of sequences for one of the Jaccard-based metrics. The non-zero
+    elements of the product of the sparse incidence matrix with its transpose are exactly the pairs that share at least
+    one API call.
+
+    :type calls: list of lists or SequenceCorpus
+    :param calls: a list of method call sequences
+    :type metric: string
+    :param metric: ['jaccard', 'jaccard-min']
+    :type max_dist: float
+    :param max_dist: the maximum distance that is stored
+    :return graph: a scipy csr_matrix
+    """
+    incidence, _ = incidence_matrix(calls)
+    set_sizes = np.asarray(incidence.sum(axis=1)).ravel()
+    inter = (incidence * incidence.T).tocoo()
+    off_diag = inter.row != inter.col
+    rows, cols, counts = inter.row[off_diag], inter.col[off_diag], inter.data[off_diag]
+    dists = sequences_metrics.JACCARD_METRICS[metric](counts, set_sizes[rows], set_sizes[cols])
+    kept = (dists < 1.0) & (dists <= max_dist)
+    return csr_matrix((dists[kept], (rows[kept], cols[kept])), shape=(len(calls), len(calls)))
+
+
+def sparse_distance_graph(calls, params):
+    """
+    Computes a sparse distance graph of a list of sequences, by only evaluating the distances of candidate pairs; every
+    other pair is at distance 1.0. The candidates are found either with an inverted index from API calls to the
+    sequences that contain them, so that each sequence is only compared to the previous sequences that share at least
+    one API call with it, or approximately with MinHash signatures and Locality-Sensitive Hashing (see
+    lsh_candidates). Note that the pairs pruned by eps, or missed by 'lsh', are also reported at distance 1.0, so the
+    support of the data points (the number of data points at distance 1.0, see clustering.support_center) is larger
+    than for the full matrix; the cluster centers of DBSCAN and HDBSCAN, and thus the top callers, may then differ
+    from the ones of the full matrix even if the clusters are the same. Without eps and with 'postings', every pair
+    that is not stored is truly at distance 1.0, so the centers are the same.
+
+    :type calls: list of lists or SequenceCorpus
+    :param calls: a list of method call sequences
+    :type params: dictionary
+    :param params: {'metric'} and the optional {'engine','eps','candidates','bands','rows','shingle','random_state'}
+    (see Preprocessor.compute_distances)
+    :return dist_mat: a SparseDistanceMatrix
+    """
+    eps = params.get('eps')
+    max_dist = 1.0 if eps is None else eps
+    engine = params.get('engine', 'bulk')
+    method = params.get('candidates', 'postings')
+    if method == 'postings' and engine == 'bulk' and params['metric'] in sequences_metrics.JACCARD_METRICS:
+        graph = sparse_jaccard_graph(calls, params['metric'], max_dist)
+        print 'Stored distances: ' + str(graph.nnz)
+        return SparseDistanceMatrix(graph)
+    if method == 'postings':
+        candidates = posting_candidates(calls)
+    elif method == 'lsh':
+        candidates = lsh_candidates(calls, params)
+    else:
+        raise NotImplementedError
+    row_func = distance_row_func(calls, params['metric'], engine, eps)
+    rows = []
+    cols = []
+    dists = []
+    for i, js in tqdm(candidates, total=len(calls)):
+        for j, dist in zip(js, row_func(i, js)):
+            if dist < 1.0 and dist <= max_dist:
+                rows.append(i)
+                cols.append(j)
+                dists.append(dist)
+    rows = np.array(rows, dtype=np.intp)
+    cols = np.array(cols, dtype=np.intp)
+    dists = np.array(dists, dtype=np.float64)
+    graph = csr_matrix((np.concatenate([dists, dists]), (np.concatenate([rows, cols]), np.concatenate([cols, rows]))),
+                       shape=(len(calls), len(calls)))
+    print 'Stored distances: ' + str(graph.nnz)
+    return SparseDistanceMatrix(graph)
+
+
+def posting_candidates(calls):
+    """
+    Generates the candidate pairs of each sequence, using an inverted index from API calls to sequences that is built
+    incrementally. The candidates of a sequence are the previous sequences that share at least one API call with it.
+
+    :type calls: list of lists or SequenceCorpus
+    :param calls: a list of method call sequences
+    :return: a generator of (i, sorted list of ids j < i)
+    """
+    _, enc_calls = sequences_metrics.encode_sequences(calls)
+    postings = {}
+    for i in range(len(enc_calls)):
+        candidates = set()
+        for call_id in set(enc_calls[i]):
+            candidates.update(postings.get(call_id, ()))
+            postings.setdefault(call_id, []).append(i)
+        yield i, sorted(candidates)
+
+
+def lsh_candidates(calls, params):
+    """
+    Generates approximate candidate pairs of each sequence, using MinHash signatures of the sets of shingles of the
+    sequences and Locality-Sensitive Hashing. Two sequences are candidates if their signatures agree on every hash
+    value of at least one of the bands, which happens with probability 1 - (1 - s^rows)^bands for a pair with Jaccard
+    similarity s between their sets of shingles. Pairs that are not candidates are assumed to be at distance 1.0, so
+    near pairs may be missed.
+
+    :type calls: list of lists or SequenceCorpus
+    :param calls: a list of method call sequences
+    :type params: dictionary
+    :param params: the optional {'bands','rows','shingle','random_state'} (see Preprocessor.compute_distances)
+    :return: a generator of (i, sorted list of ids j < i)
+    """
+    bands = params.get('bands', 16)
+    rows = params.get('rows', 4)
+    _, enc_calls = sequences_metrics.encode_sequences(calls)
+    sets = minhash.shingle_sets(enc_calls, params.get('shingle', 1))
+    signatures = minhash.minhash_signatures(sets, bands * rows, params.get('random_state', 0))
+    pairs = minhash.candidate_pairs(signatures, bands, rows)
+    print 'Candidate pairs: ' + str(len(pairs))
+    bounds = np.searchsorted(pairs[:, 0], np.arange(len(calls) + 1))
+    for i in range(len(calls)):
+        yield i, pairs[bounds[i]:bounds[i + 1], 1].tolist()
+
+
+def distance_row_func(calls, metric, engine, max_dist=None):
+    """
+    Returns a function that computes the distances between a sequence and a list of sequences, using the appropriate
+    engine for the given metric. If max_dist is given, the LCS-based and the 'levenshtein' metrics skip the pairs whose
+    lengths alone rule out a distance within max_dist, and the 'pairwise' engine uses the banded DP of
+    sequences_metrics.lcs_len_bounded and sequences_metrics.levenshtein_bounded; the distances that exceed max_dist
+    are then reported as 1.0. Every engine compares the sequences in their integer form.
+
+    :type calls: list of lists or SequenceCorpus
+    :param calls: a list of method call sequences
+    :type metric: string
+    :param metric: the metric to be used (see Preprocessor.get_dist_func)
+    :type engine: string
+    :param engine: ['bulk', 'pairwise']
+    :type max_dist: float
+    :param max_dist: the maximum distance of interest (default: None, i.e. every distance is exact)
+    :return row_func: a function (i, js) -> the distances between sequence i and each sequence of js
+    """
+    if engine not in ['bulk', 'pairwise']:
+        raise NotImplementedError
+    bounded = max_dist is not None and max_dist < 1.0
+    _, enc_calls = sequences_metrics.encode_sequences(calls)
+    if bounded and metric in sequences_metrics.LCS_METRICS:
+        from_len = sequences_metrics.LCS_METRICS[metric]
+
+        def row_func(i, js):
+            x = enc_calls[i]
+            masks = sequences_metrics.lcs_match_masks(x) if engine == 'bulk' else None
+            dists = []
+            for j in js:
+                y = enc_calls[j]
+                if from_len(min(len(x), len(y)), len(x), len(y)) > max_dist:
+                    # even the longest possible LCS is too short
+                    lcss = None
+                elif engine == 'bulk':
+                    lcss = sequences_metrics.lcs_len_bits(masks, len(x), y)
+                else:
+                    lcss = sequences_metrics.lcs_len_bounded(
+                        x, y, sequences_metrics.min_lcs_len(from_len, max_dist, len(x), len(y)))
+                dists.append(1.0 if lcss is None else from_len(lcss, len(x), len(y)))
+            return dists
+    elif bounded and metric == 'levenshtein':
+        def row_func(i, js):
+            return [sequences_metrics.levenshtein_bounded(enc_calls[i], enc_calls[j], max_dist) for j in js]
+    elif engine == 'bulk' and metric in sequences_metrics.LCS_METRICS:
+        from_len = sequences_metrics.LCS_METRICS[metric]
+        lens = np.array([len(seq) for seq in enc_calls])
+
+        def row_func(i, js):
+            lcss = np.array(sequences_metrics.lcs_len_bulk(enc_calls[i], [enc_calls[j] for j in js]))
+            return from_len(lcss, lens[i], lens[js])
+    elif engine == 'bulk' and metric in sequences_metrics.PREPARED_METRICS:
+        prepare, prepared_dist = sequences_metrics.PREPARED_METRICS[metric]
+        prepared = prepare(enc_calls)
+
+        def row_func(i, js):
+            return [prepared_dist(prepared[i], prepared[j]) for j in js]
+    else:
+        dist_func = Preprocessor.get_dist_func(metric)
+
+        def row_func(i, js):
+            return [dist_func(enc_calls[i], enc_calls[j]) for j in js]
+    return row_func
+
+
+def parallel_distance_matrix(calls, metric, engine, n_jobs, tile_size, storage='dense', precision='float32',
+                             tmp_dir=None):
+    """
+    Computes the distance matrix of a list of sequences using a pool of worker processes. The lower triangle of the
+    matrix is split into tiles, and each worker writes the distances of its tiles (and their symmetric ones) directly to
+    a memory-mapped matrix, so that no results are sent back to the parent process. The matrix is backed by a temporary
+    file in tmp_dir, which is as large as the matrix (n * n floats if dense).
+
+    :type calls: list of lists or SequenceCorpus
+    :param calls: a list of method call sequences
+    :type metric: string
+    :param metric: the metric to be used (see Preprocessor.get_dist_func)
+    :type engine: string
+    :param engine: ['bulk', 'pairwise']
+    :type n_jobs: int
+    :param n_jobs: the number of worker processes, -1 uses all cores
+    :type tile_size: int
+    :param tile_size: the number of rows/columns of each tile
+    :type storage: string
+    :param storage: ['dense', 'condensed']
+    :type precision: string
+    :param precision: ['float32', 'uint16'], only used by condensed matrices
+    :type tmp_dir: str
+    :param tmp_dir: the directory of the memory-mapped file (default: None, i.e. tempfile.gettempdir())
+    :return dist_mat: the distance matrix, backed by a numpy memmap
+    """
+    if n_jobs < 1:
+        n_jobs = cpu_count()
+    n = len(calls)
+    # the workers receive the integer form of the sequences, which is smaller to pickle
+    _, calls = sequences_metrics.encode_sequences(calls)
+    # the file is removed once the workers are done; the parent's mapping remains valid
+    if tmp_dir is None:
+        tmp_dir = tempfile.gettempdir()
+    filefunctions.make_sure_dir_exists(tmp_dir)
+    fd, mmap_path = tempfile.mkstemp(suffix='.dist', dir=tmp_dir)
+    os.close(fd)
+    dist_mat = allocate_distance_matrix(n, storage, precision, mmap_path)
+    tiles = [(r0, min(r0 + tile_size, n), c0, min(c0 + tile_size, n))
+             for r0 in range(0, n, tile_size) for c0 in range(0, r0 + 1, tile_size)]
+    pool = Pool(processes=n_jobs, initializer=init_tile_worker,
+                initargs=(mmap_path, n, storage, precision, calls, metric, engine))
+    try:
+        for _ in tqdm(pool.imap_unordered(compute_tile, tiles), total=len(tiles)):
+            pass
+    finally:
+        pool.terminate()
+        pool.join()
+        os.remove(mmap_path)
+    return dist_mat
+
+
+# the state of each worker process of parallel_distance_matrix
+tile_worker = {}
+
+
+def init_tile_worker(mmap_path, n, storage, precision, calls, metric, engine):
+    """
+    Initialises a worker process of parallel_distance_matrix.
+
+    :type mmap_path: str
+    :param mmap_path: the path of the memory-mapped distance matrix
+    :type n: int
+    :param n: the number of sequences
+    :type storage: string
+    :param storage: ['dense', 'condensed']
+    :type precision: string
+    :param precision: ['float32', 'uint16'], only used by condensed matrices
+    :type calls: list of lists
+    :param calls: a list of encoded method call sequences
+    :type metric: string
+    :param metric: the metric to be used
+    :type engine: string
+    :param engine: ['bulk', 'pairwise']
+    """
+    tile_worker['dist_mat'] = allocate_distance_matrix(n, storage, precision, mmap_path, mode='r+')
+    tile_worker['row_func'] = distance_row_func(calls, metric, engine)
+
+
+def compute_tile(tile):
+    """
+    Computes the distances of a tile of the lower triangle of the distance matrix, and writes them to the
+    memory-mapped matrix along with their symmetric ones.
+
+    :type tile: tuple
+    :param tile: (first row, last row + 1, first column, last column + 1)
+    :return: the number of rows of the tile
+    """
+    r0, r1, c0, c1 = tile
+    dist_mat = tile_worker['dist_mat']
+    row_func = tile_worker['row_func']
+    for i in range(r0, r1):
+        c_end = min(c1, i + 1)
+        if c_end <= c0:
+            continue
+        store_row(dist_mat, i, c0, row_func(i, range(c0, c_end)))
+    return r1 - r0
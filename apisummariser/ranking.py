@@ -2,7 +2,7 @@ import os
 from shutil import copyfile
 
 from apisummariser.helper.filefunctions import make_sure_dir_exists
-from apisummariser.helper.sequences_metrics import is_subseq
+from apisummariser.helper.subsequence_index import SubsequenceIndex
 
 
 class Ranker:
@@ -13,7 +13,7 @@ class Ranker:
         :param res_dir: the directory where the results of the current session are stored
         :type snippets_map: dictionary
         :param snippets_map: contains information about the mined snippets
-        :type calls: list
+        :type calls: list of lists or SequenceCorpus
         :param calls: the original list of API calls
         """
         self.res_dir = res_dir
@@ -26,15 +26,14 @@ class Ranker:
         """
         Ranks mined snippets based on their support in the original dataset. We claim that a mined snippet is support by
         a file in the original dataset, if the latter's API call sequence is a super-sequence of the first's sequence.
+        The supersequences are found with an index of the dataset (see subsequence_index.SubsequenceIndex), and a
+        snippet that invokes an API call which is not in the dataset has no support.
         """
+        index = SubsequenceIndex(self.calls)
         snippets_info = []
         for key, value in self.medoids_map.iteritems():
             name = str(key) + '_' + value[0]['filename']
-            support = 0
-            seq1 = value[0]['calls']
-            for seq2 in self.calls:
-                if is_subseq(seq1,seq2):
-                    support+= 1
+            support = index.support(value[0]['calls'])
             snippets_info.append({'name':name, 'support': support, 'calls': value[0]['calls']})
         self.snippets_rank = sorted(snippets_info, key=lambda k: k['support'], reverse=True)
 
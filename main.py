@@ -24,12 +24,13 @@ def main():
 
     print "Loading dataset..."
     org_caller_file, org_caller_package, org_callers, org_calls = summariser.filefunctions.load_arff(
-        paths.arff_file_path, omit=8)
+        paths.arff_file_path, omit=8, cache_dir=paths.cache_dir)
     print "Dataset loaded!\n"
 
     print "Preprocessing data..."
     preprocessor = summariser.Preprocessor(org_caller_file, org_caller_package, org_callers, org_calls)
-    params_pre = {'metric': 'lcs', 'remove_singletons': True, 'remove_pseudo_singletons': True, 'remove_unique': False}
+    params_pre = {'metric': 'lcs', 'remove_singletons': True, 'remove_pseudo_singletons': True, 'remove_unique': False,
+                  'cache_dir': paths.cache_dir}
     preprocessor.perform_preprocessing(mode='distance', params=params_pre)
     callers_file, callers_package, callers, calls, dist_mat = preprocessor.callers_file, preprocessor.callers_package, \
                                                               preprocessor.callers, preprocessor.calls, preprocessor.dist_mat